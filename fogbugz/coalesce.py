@@ -0,0 +1,126 @@
+#   Copyright (C) 2010 Henry Ludemann <misc@hl.id.au>
+#
+#   This file is part of the fogbugz import/export library.
+#
+#   The fogbugz import/export library is free software; you can redistribute it
+#   and/or modify it under the terms of the GNU Lesser General Public
+#   License as published by the Free Software Foundation; either
+#   version 2.1 of the License, or (at your option) any later version.
+#
+#   The fogbugz import/export library is distributed in the hope that it will be
+#   useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+#   of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#   Lesser General Public License for more details.
+#
+#   You should have received a copy of the GNU Lesser General Public
+#   License along with this library; if not, see
+#   <http://www.gnu.org/licenses/>.
+
+"""Coalesce the changes to an issue into fewer requests.
+
+Both tools upload an issue as a list of (cmd, params, files) commands, where
+the params of each command hold the full state of the issue after it. A burst
+of commands by the same person can often be sent as one request.
+"""
+
+import logging
+import threading
+
+class Coalescer:
+    def __init__(self, window, actor, time, separate=()):
+        """
+        window -- Merge commands by the same person at most this many seconds
+            apart.
+        actor -- The name of the param holding the person making the change.
+        time -- A function returning the time (in seconds) of a command's params.
+        separate -- Params that are never merged into an earlier command (eg:
+            parents, which may not exist at the time of the earlier command).
+        """
+        self._window = window
+        self._actor = actor
+        self._time = time
+        self._separate = set(separate)
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.merged = 0
+        self.dropped = 0
+
+    def _state(self, params):
+        return dict((name, value) for name, value in params.items()
+                if name not in ('dt', 'sEvent', self._actor))
+
+    def _changed(self, before, after):
+        return set(name for name, value in after.items() if before.get(name) != value)
+
+    def _count(self, name):
+        self._lock.acquire()
+        try:
+            setattr(self, name, getattr(self, name) + 1)
+        finally:
+            self._lock.release()
+
+    def _can_merge(self, pending, cmd, params, changed):
+        pending_cmd, pending_params, pending_files, pending_changed = pending
+        if 'edit' not in (pending_cmd, cmd):
+            # Only one of them can change the status.
+            return False
+        if pending_params[self._actor] != params[self._actor]:
+            return False
+        if not 0 <= self._time(params) - self._time(pending_params) <= self._window:
+            return False
+        if pending_params.get('sEvent') and params.get('sEvent'):
+            return False
+        # A field changed by both would lose the earlier value (and the
+        # merged command happens at the time of the earlier command).
+        return not (changed & pending_changed) and not (changed & self._separate)
+
+    def coalesce(self, commands, count=True):
+        """Yield the (cmd, params, files) commands of an issue, coalesced.
+
+        Commands by the same person within the window are merged if no field
+        or message would be lost, and edits that change nothing are dropped.
+
+        count -- Include the commands in the statistics (false if the commands
+            of the issue will be coalesced again).
+        """
+        state = {}
+        pending = None
+        for cmd, params, files in commands:
+            if count:
+                self._count('requests')
+            if 'dt' not in params:
+                # This command doesn't hold the state (eg: a close).
+                if pending is not None:
+                    yield pending[:3]
+                    pending = None
+                yield cmd, params, files
+                continue
+
+            fields = self._state(params)
+            changed = self._changed(state, fields)
+            if cmd == 'edit' and not changed and not files and not params.get('sEvent'):
+                if count:
+                    self._count('dropped')
+                continue
+            if pending is not None and self._can_merge(pending, cmd, params, changed):
+                pending_cmd, pending_params, pending_files, pending_changed = pending
+                merged = dict(params)
+                merged['dt'] = pending_params['dt']
+                if pending_params.get('sEvent'):
+                    merged['sEvent'] = pending_params['sEvent']
+                pending = (pending_cmd if cmd == 'edit' else cmd, merged,
+                        list(pending_files) + list(files), pending_changed | changed)
+                if count:
+                    self._count('merged')
+            else:
+                if pending is not None:
+                    yield pending[:3]
+                pending = (cmd, params, files, changed)
+            state = fields
+        if pending is not None:
+            yield pending[:3]
+
+    def log_statistics(self):
+        logging.info('Coalescing removed %i of %i requests (%i merged, %i '
+                'unchanged).', self.merged + self.dropped, self.requests,
+                self.merged, self.dropped)
@@ -25,8 +25,77 @@ from StringIO import StringIO
 import sys
 import urllib
 import urlparse
-from xml.etree import ElementTree
+try:
+    from xml.etree import cElementTree as ElementTree
+except ImportError:
+    from xml.etree import ElementTree
 from xml.parsers.expat import ExpatError
+import zlib
+
+# Request bodies smaller than this aren't worth compressing.
+_MIN_COMPRESSED_SIZE = 1024
+
+# The statuses of a server that doesn't accept compressed requests.
+_REJECTED_STATUSES = (400, 415)
+
+class _DecodedResponse:
+    """A file like object that decodes a (possibly compressed) http response.
+
+    The response is decompressed as it is read, so it can be fed to an
+    incremental parser.
+
+    finished -- Called with the _DecodedResponse once it has all been read.
+    """
+    def __init__(self, response, encoding, finished=None):
+        self._response = response
+        self._finished = finished
+        self._encoding = (encoding or 'identity').strip().lower()
+        if self._encoding == 'gzip':
+            self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif self._encoding == 'deflate':
+            # Servers disagree on whether 'deflate' has a zlib header; we
+            # check when we see the first chunk.
+            self._decompressor = None
+        elif self._encoding == 'identity':
+            self._decompressor = None
+        else:
+            sys.exit("Unknown content encoding '%s'!" % encoding)
+        self.compressed_size = 0
+        self.size = 0
+
+    def _decode(self, data):
+        if self._encoding == 'identity':
+            return data
+        if self._decompressor is None:
+            try:
+                self._decompressor = zlib.decompressobj()
+                return self._decompressor.decompress(data)
+            except zlib.error:
+                self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        return self._decompressor.decompress(data)
+
+    def read(self, size=65536):
+        while 1:
+            data = self._response.read(size)
+            self.compressed_size += len(data)
+            if not data:
+                result = self._decompressor.flush() if self._decompressor else ''
+                self.size += len(result)
+                if self._finished is not None:
+                    finished, self._finished = self._finished, None
+                    finished(self)
+                return result
+            result = self._decode(data)
+            if result:
+                self.size += len(result)
+                return result
+
+    def chunks(self):
+        while 1:
+            data = self.read()
+            if not data:
+                break
+            yield data
 
 class BaseConnection:
     def __init__(self, server, name=None):
@@ -41,6 +110,10 @@ class BaseConnection:
         """Post a request to the fogbugz server."""
         raise NotImplementedError()
 
+    def _post_tree(self, args, files):
+        """Post a request to the fogbugz server, returning the parsed response."""
+        return self._parse(self._post(args, files))
+
     def post(self, cmd, args, files=[], element=None):
         """Post a single change to fogbugz.
 
@@ -56,41 +129,105 @@ class BaseConnection:
         args['cmd'] = cmd
 
         # Log a debug message to show what is going on...
-        temp = list(args.items())
-        temp.sort()
-        logging.debug('%s - %s %s', self._name, temp, [filename for filename, contents in files])
+        if logging.root.isEnabledFor(logging.DEBUG):
+            logging.debug('%s - %s %s', self._name, sorted(args.items()),
+                    [filename for filename, contents in files])
+
+        tree = self._post_tree(args, files)
+        return self._get_element(tree, element)
+
+    def _post_file(self, args, files):
+        """Post a request, returning a file like object to read the response."""
+        return StringIO(self._post(args, files))
 
-        xml = self._post(args, files)
-        return self._get_element(xml, element)
+    def post_elements(self, cmd, args, tag):
+        """Post a request, yielding the elements with the given tag as they are
+        parsed (eg: each case of a search).
+
+        The yielded elements are removed from the response, so the response
+        is never held as a whole; an element is freed once the caller is done
+        with it.
+        """
+        if self._token is not None:
+            args['token'] = self._token
+        args['cmd'] = cmd
+        if logging.root.isEnabledFor(logging.DEBUG):
+            logging.debug('%s - %s', self._name, sorted(args.items()))
+        parents = []
+        try:
+            for event, element in ElementTree.iterparse(self._post_file(args, []),
+                    events=('start', 'end')):
+                if event == 'start':
+                    parents.append(element)
+                    continue
+                parents.pop()
+                if element.tag == tag:
+                    yield element
+                    if parents:
+                        parents[-1].remove(element)
+                elif element.tag == 'error' and len(parents) == 1:
+                    sys.exit(ElementTree.tostring(element))
+        except (ExpatError, SyntaxError), ex:
+            sys.exit('Failed to parse the response from %s: %s' % (self._name, ex))
 
     def _get_attachment(self, url):
         raise NotImplementedError()
 
+    def log_statistics(self):
+        """Log the number of bytes transferred by this connection."""
+        pass
+
     def get_attachment(self, path):
         url = self._server.path + path + '&token=' + self._token
         logging.info('Asking for attachment at %s', url)
         return self._get_attachment(url)
 
-    def _get_element(self, xml, element):
+    def _parse(self, xml):
         try:
-            tree = ElementTree.parse(StringIO(xml)).getroot()
-        except ExpatError, ex:
+            return ElementTree.fromstring(xml)
+        except (ExpatError, SyntaxError), ex:
             logging.debug('%s', xml)
             sys.exit(str(ex))
+
+    def _get_element(self, tree, element):
+        """Get an element from a response (either xml text or a parsed tree)."""
+        if isinstance(tree, basestring):
+            tree = self._parse(tree)
         if tree.find('error') is not None:
-            sys.exit(xml)
+            sys.exit(ElementTree.tostring(tree))
         if element is not None:
-            tree = tree.find(element)
-            if tree is None:
-                sys.exit("Failed to find element '%s' in:\n%s" % (element, xml))
-        return tree;
+            result = tree.find(element)
+            if result is None:
+                sys.exit("Failed to find element '%s' in:\n%s" % (element, ElementTree.tostring(tree)))
+            return result
+        return tree
 
 
 class Connection(BaseConnection):
-    def __init__(self, hostaddress, name=None):
+    """A connection to a fogbugz server.
+
+    Responses are requested with gzip / deflate compression. If
+    compress_requests is set, large request bodies are sent gzipped; if the
+    server rejects the first one, compression is disabled for the rest of the
+    connection."""
+    def __init__(self, hostaddress, name=None, compress_requests=False):
         self._connection = None
         self._username = None
         self._password = None
+        self._request_encoding = 'gzip' if compress_requests else None
+        self._request_encoding_checked = False
+        self._sent = 0
+        self._sent_uncompressed = 0
+        self._received = 0
+        self._received_decoded = 0
+
+        # The multipart boundary (and the headers using it) are created once
+        # for the connection, rather than for every request.
+        self._boundary = '----------' + ''.join(
+                random.choice(string.ascii_letters) for i in range(16))
+        self._content_type = 'multipart/form-data; boundary=%s' % self._boundary
+        self._field_headers = {}
+        self._end_boundary = '--%s--\r\n' % self._boundary
 
         server = urlparse.urlparse(hostaddress)
         while not server.username:
@@ -111,28 +248,81 @@ class Connection(BaseConnection):
                 sys.exit("Unknown server scheme '%s'!" % self._server.scheme)
 
             # Request the 'live' url
-            self.connection.request('GET', self._server.path + '/api.xml')
-            self._http_path = '/%s' % self._get_element(self._get_response(), 'url').text
+            self.connection.request('GET', self._server.path + '/api.xml',
+                    headers={'Accept-Encoding':'gzip, deflate'})
+            self._http_path = '/%s' % self._get_element(self._get_response(True), 'url').text
         self.logon()
 
+    def _files(self, files):
+        return [('File%i' % (i+1), name, contents) for i, (name, contents) in enumerate(files)]
+
     def _post(self, args, files):
+        return self._post_multipart("POST", self._http_path, args.items(), self._files(files))
+
+    def _post_tree(self, args, files):
         return self._post_multipart("POST", self._http_path, args.items(),
-                [('File%i' % (i+1), name, contents) for i, (name, contents) in enumerate(files)])
+                self._files(files), parse=True)
+
+    def _post_file(self, args, files):
+        return self._post_multipart("POST", self._http_path, args.items(),
+                self._files(files), parse='file')
                
     def _get_attachment(self, url):
-        self.connection.request('GET', url)
+        self.connection.request('GET', url, headers={'Accept-Encoding':'gzip, deflate'})
         return self._get_response()
 
-    def _post_multipart(self, host, selector, fields, files):
+    def _compress(self, body):
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress(body) + compressor.flush()
+
+    def _post_multipart(self, host, selector, fields, files, parse=False):
         content_type, body = self._encode_multipart_formdata(fields, files)
+        encoding = None
+        if self._request_encoding and len(body) >= _MIN_COMPRESSED_SIZE:
+            encoding = self._request_encoding
+            data = self._compress(body)
+        else:
+            data = body
+        self._sent_uncompressed += len(body)
         while 1:
             try:
-                self.connection.putrequest('POST', selector)
+                self.connection.putrequest('POST', selector, skip_accept_encoding=True)
+                self.connection.putheader('accept-encoding', 'gzip, deflate')
                 self.connection.putheader('content-type', content_type)
-                self.connection.putheader('content-length', len(body))
-                self.connection.endheaders()
-                self.connection.send(body)
-                return self._get_response()
+                if encoding:
+                    self.connection.putheader('content-encoding', encoding)
+                self.connection.putheader('content-length', len(data))
+                # Send the headers and the body together, so small requests
+                # go in a single packet.
+                self.connection.endheaders(data)
+                self._sent += len(data)
+                if encoding and not self._request_encoding_checked:
+                    # Check the server understood the compressed request. Only
+                    # a rejected request is sent again uncompressed; any other
+                    # response (even an api error, or one we can't read) may
+                    # mean the request was applied.
+                    response = self.connection.getresponse()
+                    if response.status in _REJECTED_STATUSES:
+                        response.read()
+                        logging.info("%s doesn't accept compressed requests; sending "
+                                "them uncompressed.", self._name)
+                        self._request_encoding = encoding = None
+                        data = body
+                        continue
+                    if response.status != 200:
+                        sys.exit('Fogbugz server failure %i: %s' % (
+                            response.status, response.reason))
+                    try:
+                        xml = self._read_response(response)
+                        tree = ElementTree.fromstring(xml)
+                    except (ExpatError, SyntaxError, zlib.error), ex:
+                        sys.exit("Unreadable response from %s to a compressed request "
+                                "(%s); try without '--compress-requests'." % (self._name, ex))
+                    self._request_encoding_checked = True
+                    if parse == 'file':
+                        return StringIO(xml)
+                    return tree if parse else xml
+                return self._get_response(parse)
             except socket.error, ex:
                 logging.error('Socket error (%s); logging in again...', ex)
                 self._reconnect()
@@ -141,33 +331,67 @@ class Connection(BaseConnection):
                 self._reconnect()
 
     def _encode_multipart_formdata(self, fields, files):
-        boundary = '----------' + ''.join(
-                string.ascii_letters[random.randint(0, len(string.ascii_letters)-1)]
-                for i in range(16))
-        CRLF = '\r\n'
-        L = []
+        parts = []
+        append = parts.append
+        headers = self._field_headers
         for (key, value) in fields:
-            L.append('--' + boundary)
-            L.append('Content-Disposition: form-data; name="%s"' % key)
-            L.append('')
-            L.append(value)
+            try:
+                header = headers[key]
+            except KeyError:
+                header = headers[key] = '--%s\r\nContent-Disposition: form-data; name="%s"\r\n\r\n' % (
+                        self._boundary, key)
+            append(header)
+            append(value.encode('utf8') if isinstance(value, unicode) else str(value))
+            append('\r\n')
         for (key, filename, value) in files:
-            L.append('--' + boundary)
-            L.append('Content-Disposition: form-data; name="%s"; filename="%s"' % (key, filename))
-            L.append('Content-Type: application/octet-stream')
-            L.append('')
-            L.append(value)
-        L.append('--' + boundary + '--')
-        L.append('')
-        body = CRLF.join(str(l) if not isinstance(l, unicode) else l.encode('utf8') for l in L)
-        content_type = 'multipart/form-data; boundary=%s' % boundary
-        return content_type, body
-
-    def _get_response(self):
+            header = '--%s\r\nContent-Disposition: form-data; name="%s"; filename="%s"\r\n' \
+                    'Content-Type: application/octet-stream\r\n\r\n' % (self._boundary, key, filename)
+            append(header.encode('utf8') if isinstance(header, unicode) else header)
+            append(value.encode('utf8') if isinstance(value, unicode) else str(value))
+            append('\r\n')
+        append(self._end_boundary)
+        return self._content_type, ''.join(parts)
+
+    def _count_received(self, decoded):
+        self._received += decoded.compressed_size
+        self._received_decoded += decoded.size
+
+    def _read_response(self, response, parse=False):
+        """Read a response, parsing it as it arrives if parse is set.
+
+        parse -- If 'file', return a file like object to read the (decoded)
+            response from.
+        """
+        decoded = _DecodedResponse(response, response.getheader('content-encoding'),
+                self._count_received)
+        if parse == 'file':
+            return decoded
+        elif parse:
+            parser = ElementTree.XMLParser()
+            try:
+                for chunk in decoded.chunks():
+                    parser.feed(chunk)
+                result = parser.close()
+            except (ExpatError, SyntaxError), ex:
+                sys.exit('Failed to parse the response from %s: %s' % (self._name, ex))
+        else:
+            result = ''.join(decoded.chunks())
+        return result
+
+    def _get_response(self, parse=False):
         response = self.connection.getresponse()
         if response.status != 200:
             sys.exit('Fogbugz server failure %i: %s' % (response.status, response.reason))
-        return response.read()
+        return self._read_response(response, parse)
+
+    def log_statistics(self):
+        def saving(size, total):
+            return 100.0 * (total - size) / total if total else 0.0
+        logging.info('%s: received %i bytes (%i decoded, %.1f%% saved by '
+                'compression), sent %i bytes (%i uncompressed, %.1f%% saved).',
+                self._name, self._received, self._received_decoded,
+                saving(self._received, self._received_decoded), self._sent,
+                self._sent_uncompressed, saving(self._sent, self._sent_uncompressed))
 
 
 class MockConnection(BaseConnection):
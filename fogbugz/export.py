@@ -16,15 +16,141 @@
 #   License along with this library; if not, see
 #   <http://www.gnu.org/licenses/>.
 
-from collections import namedtuple
-import copy
+import cPickle
+import heapq
 import logging
+import multiprocessing
+import os
+import Queue
 import re
 import sys
+import tempfile
+import threading
+
+from fogbugz.connection import ElementTree
 
 class ExportError (Exception):
     pass
 
+# Values of these fields are repeated across many changes, so we share them.
+# The table is cleared when it gets this big, so a large export (eg: with
+# many distinct tag sets) can't grow it without bound.
+_interned_fields = set(['sProject', 'sStatus', 'sCategory', 'ixPriority',
+    'ixPersonAssignedTo', 'ixPerson', 'tags'])
+_interned = {}
+_interned_limit = 10000
+
+def _intern(value):
+    try:
+        return _interned[value]
+    except KeyError:
+        if len(_interned) >= _interned_limit:
+            _interned.clear()
+        _interned[value] = value
+        return value
+_field_names = {}
+
+class Change(object):
+    """The state of an issue after a change.
+
+    This behaves like a dictionary of the issue's fields, but uses slots, and
+    shares the repeated values (projects, statuses, tag sets, ...) between
+    changes. The tags are a frozenset, so unchanged tags are shared between
+    adjacent changes.
+    """
+    __slots__ = ('ixBug', 'sProject', 'sTitle', 'ixPriority', 'ixBugParent',
+            'sStatus', 'sCategory', 'ixPersonAssignedTo', 'tags', 'attachments',
+            'dt', 'ixPerson', 'sEvent')
+
+    def __init__(self, items=()):
+        for name, value in items:
+            self[name] = value
+
+    def __getitem__(self, name):
+        try:
+            return getattr(self, name)
+        except AttributeError:
+            raise KeyError(name)
+
+    def __setitem__(self, name, value):
+        if name in _interned_fields:
+            if name == 'tags':
+                value = frozenset(value)
+            value = _intern(value)
+        setattr(self, name, value)
+
+    def __delitem__(self, name):
+        try:
+            delattr(self, name)
+        except AttributeError:
+            raise KeyError(name)
+
+    def __contains__(self, name):
+        return hasattr(self, name)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def keys(self):
+        return [name for name in self.__slots__ if hasattr(self, name)]
+
+    def items(self):
+        return [(name, getattr(self, name)) for name in self.__slots__ if hasattr(self, name)]
+
+    def get(self, name, default=None):
+        return getattr(self, name, default)
+
+    def pop(self, name, *default):
+        try:
+            result = getattr(self, name)
+        except AttributeError:
+            if default:
+                return default[0]
+            raise KeyError(name)
+        delattr(self, name)
+        return result
+
+    def update(self, items):
+        for name, value in (items.items() if hasattr(items, 'items') else items):
+            self[name] = value
+
+    def copy(self):
+        """Copy the change; only the attachments list isn't shared."""
+        result = Change.__new__(Change)
+        for name, value in self.items():
+            setattr(result, name, value)
+        if hasattr(self, 'attachments'):
+            result.attachments = list(self.attachments)
+        return result
+
+    def __getstate__(self):
+        # The tuple of names is shared between changes, so it is only pickled
+        # once (eg: when a pool process sends back the changes of many cases).
+        names = tuple(self.keys())
+        names = _field_names.setdefault(names, names)
+        return names, tuple(getattr(self, name) for name in names)
+
+    def __setstate__(self, state):
+        # Share the values again (eg: when the change was reconstructed in
+        # another process).
+        for name, value in zip(*state):
+            self[name] = value
+
+    def __eq__(self, other):
+        if isinstance(other, (Change, dict)):
+            return dict(self.items()) == dict(other.items())
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    def __repr__(self):
+        return 'Change(%r)' % dict(self.items())
+
 def _update(issue, event, names):
     for name in names:
         issue[name] = event.find(name).text
@@ -102,7 +228,7 @@ def _changes(issue, events):
 
     previous = {}
     issue['attachments'] = []
-    current = copy.deepcopy(issue)
+    current = issue.copy()
     for event in events:
         # As we are walking back in time, we are already in the state as
         # described in event. We get the timestamp and person who put us
@@ -154,24 +280,232 @@ def _changes(issue, events):
                     if filename not in uploads]
             previous = current
         current = issue
-        issue = copy.deepcopy(issue)
+        issue = issue.copy()
 
     yield issue
 
-def get_issues(source, search):
-    columns = ['sProject', 'sTitle', 'ixPriority', 'ixBugParent', 'sStatus', 'sCategory', 'ixPersonAssignedTo', 'ixBug']
+def _opened(case):
+    """Get the (timestamp, ixBug) of the first event of a case."""
+    dt = case.find('events/event/dt')
+    return (dt.text if dt is not None else ''), int(case.find('ixBug').text)
+
+columns = ['sProject', 'sTitle', 'ixPriority', 'ixBugParent', 'sStatus', 'sCategory', 'ixPersonAssignedTo', 'ixBug']
+
+def search_params(search):
+    """Get the params for a 'search' returning everything get_issues needs."""
     params = {'cols':','.join(columns + ['tags','events'])}
     if search:
         params['q'] = search
+    return params
+
+def _case_changes(case):
+    """Reconstruct the list of changes to a case (most recent change first)."""
+    issue = Change()
+    _update(issue, case, columns)
+    issue['tags'] = frozenset(t.text for t in case.findall('tags/tag'))
+    return list(_changes(issue, case.findall('events/event')))
+
+# The cases being reconstructed by a pool. Forked pool processes inherit them,
+# so only their index has to be sent.
+_pool_cases = None
+
+def _indexed_changes(i):
+    return _case_changes(_pool_cases[i])
+
+def _fragment_changes(xml):
+    return _case_changes(ElementTree.fromstring(xml))
+
+def _pool_changes(cases, processes, chunksize, ordered):
+    global _pool_cases
+    _pool_cases = cases
+    try:
+        pool = multiprocessing.Pool(processes)
+    finally:
+        _pool_cases = None
+    finished = False
+    try:
+        if hasattr(os, 'fork'):
+            function, items = _indexed_changes, xrange(len(cases))
+        else:
+            # The pool processes start afresh, so they need the case xml.
+            function, items = _fragment_changes, (ElementTree.tostring(case) for case in cases)
+        if ordered:
+            results = pool.imap(function, items, chunksize)
+        else:
+            results = pool.imap_unordered(function, items, chunksize)
+        for changes in results:
+            yield changes
+        finished = True
+    finally:
+        # The pool is only terminated if it failed, or the caller stopped
+        # early (closing the generator); otherwise its processes exit cleanly.
+        if finished:
+            pool.close()
+        else:
+            pool.terminate()
+        pool.join()
+
+def _sorted_changes(cases):
+    """Yield the changes of the cases in the order they were opened.
+
+    Each case is reconstructed as it arrives, and its changes are spilled to a
+    temporary file; only the order of the cases is held in memory.
+    """
+    spill = tempfile.TemporaryFile()
+    try:
+        index = []
+        for case in cases:
+            index.append((_opened(case), spill.tell()))
+            cPickle.dump(_case_changes(case), spill, 2)
+        index.sort()
+        for opened, offset in index:
+            spill.seek(offset)
+            yield cPickle.load(spill)
+    finally:
+        spill.close()
+
+def get_issues(source, search, sort=False, processes=None, chunksize=16, ordered=True):
+    """Yield the list of changes for each issue (most recent change first).
+
+    The search is parsed as it arrives, and each case is reconstructed (and
+    freed) as it is parsed, so the search results are never held as a whole.
+
+    sort -- If true, yield the issues in the order they were opened. As the
+        whole search has to be read first, the changes are spilled to a
+        temporary file until it has been.
+    processes -- Reconstruct the histories in a pool of this many processes
+        (instead of in this process). The pool processes share the parsed
+        search, so it is held in memory.
+    chunksize -- The number of cases sent to a pool process at a time.
+    ordered -- If false (and not sorting), the pool yields the issues as they
+        are reconstructed, rather than in the order of the search.
+    """
     logging.info('Loading issues from database...')
-    search_results = source.post('search', params)
+    cases = source.post_elements('search', search_params(search), 'case')
+    if processes:
+        cases = list(cases)
+        if sort:
+            cases.sort(key=_opened)
+        for changes in _pool_changes(cases, processes, chunksize, ordered or sort):
+            yield changes
+    elif sort:
+        for changes in _sorted_changes(cases):
+            yield changes
+    else:
+        for case in cases:
+            yield _case_changes(case)
+
+def _search_opened(source, search):
+    """Get the sorted (dtOpened, ixBug) of the cases matching a search (without
+    events). The date is empty if the server doesn't return it."""
+    params = {'cols':'ixBug,dtOpened'}
+    if search:
+        params['q'] = search
+    return sorted((case.findtext('dtOpened') or '', int(case.find('ixBug').text))
+            for case in source.post('search', params).findall('cases/case'))
+
+def split_shards(items, count):
+    """Split a list into at most 'count' contiguous parts of similar size."""
+    size = max(1, -(-len(items) // count))
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+class ShardFetcher:
+    """Fetch shards of cases concurrently, using a thread per connection.
 
-    for case in search_results.findall('cases/case'):
-        issue = dict_from_element(case, columns)
-        issue['tags'] = set(t.text for t in case.findall('tags/tag'))
+    connections -- The connections to search with (one thread each).
+    shards -- A list of lists of ixBugs.
+    retries -- The number of times to retry a shard before giving up.
+    params -- A function returning the search params for a search string.
+    """
+    def __init__(self, connections, shards, retries, params=search_params):
+        self._shards = shards
+        self._retries = retries
+        self._params = params
+        self._results = [None] * len(shards)
+        self._ready = threading.Condition()
+        self._pending = Queue.Queue()
+        for i in range(len(shards)):
+            self._pending.put(i)
+        for connection in connections:
+            thread = threading.Thread(target=self._run, args=(connection,))
+            thread.daemon = True
+            thread.start()
 
-        changes = []
-        for change in _changes(issue, case.findall('events/event')):
-            changes.append(change)
-        yield changes
+    def _fetch(self, connection, shard):
+        search = ','.join(str(ixbug) for ixbug in shard)
+        for attempt in range(self._retries + 1):
+            try:
+                return connection.post('search', self._params(search)).findall('cases/case')
+            except (Exception, SystemExit), ex:
+                # The connection exits on bad responses; retry those too.
+                logging.warning('Failed to load cases %i to %i (%s)%s', shard[0],
+                        shard[-1], ex, '; retrying...' if attempt < self._retries else '!')
+        return ExportError('Failed to load cases %i to %i after %i attempts!' % (
+                shard[0], shard[-1], self._retries + 1))
 
+    def _run(self, connection):
+        while 1:
+            try:
+                i = self._pending.get_nowait()
+            except Queue.Empty:
+                return
+            result = self._fetch(connection, self._shards[i])
+            self._ready.acquire()
+            self._results[i] = result
+            self._ready.notifyAll()
+            self._ready.release()
+
+    def get(self, i):
+        """Wait for a shard, returning its list of case elements."""
+        self._ready.acquire()
+        try:
+            while self._results[i] is None:
+                # Wait with a timeout, so we can still be interrupted.
+                self._ready.wait(1)
+            result, self._results[i] = self._results[i], []
+        finally:
+            self._ready.release()
+        if isinstance(result, ExportError):
+            raise result
+        logging.info('Loaded cases %i to %i.', self._shards[i][0], self._shards[i][-1])
+        return result
+
+def get_issues_sharded(source, connections, search, shards, sort=False, retries=3):
+    """Yield the same issues as get_issues, fetching them in parallel.
+
+    The matching case numbers are listed with a single cheap search, and split
+    into shards that are fetched over the connections at once.
+
+    source -- The connection used to list the cases.
+    connections -- The connections to fetch the shards with (one thread each).
+    shards -- The number of shards to split the cases into.
+    sort -- If true, yield the issues in the order they were opened. The shards
+        are split in the order the cases were listed as opened, so the issues
+        of each shard are yielded as it arrives.
+    retries -- The number of times to retry loading a shard.
+    """
+    logging.info('Listing issues in database...')
+    listed = _search_opened(source, search)
+    if not sort:
+        listed.sort(key=lambda (opened, ixbug):ixbug)
+    listed = split_shards(listed, shards)
+    shards = [[ixbug for opened, ixbug in shard] for shard in listed]
+    logging.info('Loading %i issues in %i shards over %i connections...',
+            sum(len(shard) for shard in shards), len(shards), len(connections))
+    fetcher = ShardFetcher(connections, shards, retries)
+    if sort:
+        # A loaded case can be yielded once it was opened before the first
+        # case listed in the next shard. If the listing has no dates, the
+        # bound is never reached, and everything is yielded at the end.
+        pending = []
+        for i in range(len(shards)):
+            for case in fetcher.get(i):
+                heapq.heappush(pending, (_opened(case), case))
+            bound = listed[i + 1][0] if i + 1 < len(listed) else None
+            while pending and (bound is None or pending[0][0] < bound):
+                yield _case_changes(heapq.heappop(pending)[1])
+    else:
+        # Reconstruct each shard as it arrives, while the rest are loading.
+        for i in range(len(shards)):
+            for case in fetcher.get(i):
+                yield _case_changes(case)
@@ -0,0 +1,73 @@
+#   Copyright (C) 2010 Henry Ludemann <misc@hl.id.au>
+#
+#   This file is part of the fogbugz import/export library.
+#
+#   The fogbugz import/export library is free software; you can redistribute it
+#   and/or modify it under the terms of the GNU Lesser General Public
+#   License as published by the Free Software Foundation; either
+#   version 2.1 of the License, or (at your option) any later version.
+#
+#   The fogbugz import/export library is distributed in the hope that it will be
+#   useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+#   of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#   Lesser General Public License for more details.
+#
+#   You should have received a copy of the GNU Lesser General Public
+#   License along with this library; if not, see
+#   <http://www.gnu.org/licenses/>.
+
+import logging
+import Queue
+import threading
+
+_end = object()
+
+def _consume(name, queue, consumer, errors):
+    failed = False
+    while 1:
+        item = queue.get()
+        if item is _end:
+            return
+        if failed:
+            # Keep draining the queue, so the others aren't held up.
+            continue
+        try:
+            consumer(item)
+        except BaseException, ex:
+            logging.error('%s failed (%s); skipping the rest of its changes.', name, ex)
+            errors[name] = ex
+            failed = True
+
+def fan_out(items, consumers, buffer_size=1000):
+    """Send each item to every consumer, running each consumer in its own thread.
+
+    Every consumer gets the items in order from its own queue. A slow consumer
+    only holds up the others once 'buffer_size' items are waiting for it. The
+    items are shared between the consumers, so they mustn't be modified.
+
+    consumers -- A list of (name, function) tuples; the function is called
+        with each item.
+    return -- A dictionary of the consumers that failed, and their exceptions.
+    """
+    errors = {}
+    queues = []
+    threads = []
+    for name, consumer in consumers:
+        queue = Queue.Queue(buffer_size)
+        thread = threading.Thread(target=_consume, args=(name, queue, consumer, errors))
+        thread.daemon = True
+        thread.start()
+        queues.append(queue)
+        threads.append(thread)
+    try:
+        for item in items:
+            if len(errors) == len(consumers):
+                break
+            for queue in queues:
+                queue.put(item)
+    finally:
+        for queue in queues:
+            queue.put(_end)
+        for thread in threads:
+            thread.join()
+    return errors
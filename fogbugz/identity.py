@@ -0,0 +1,135 @@
+#   Copyright (C) 2010 Henry Ludemann <misc@hl.id.au>
+#
+#   This file is part of the fogbugz import/export library.
+#
+#   The fogbugz import/export library is free software; you can redistribute it
+#   and/or modify it under the terms of the GNU Lesser General Public
+#   License as published by the Free Software Foundation; either
+#   version 2.1 of the License, or (at your option) any later version.
+#
+#   The fogbugz import/export library is distributed in the hope that it will be
+#   useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+#   of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#   Lesser General Public License for more details.
+#
+#   You should have received a copy of the GNU Lesser General Public
+#   License along with this library; if not, see
+#   <http://www.gnu.org/licenses/>.
+
+"""A persistent map of the people & projects created in a destination.
+
+The cache is a file of json lines; the first line names the source and
+destination, and each following line is a [kind, key, value] entry. New
+entries are appended as they are created (so an interrupted run doesn't lose
+them), and the file is rewritten atomically when stale entries are removed.
+"""
+
+import json
+import logging
+import os
+import threading
+import urlparse
+
+def server_name(url):
+    """Get the name of a server from its url, without the username & password."""
+    url = urlparse.urlparse(url)
+    return url.netloc.split('@')[-1] + url.path
+
+class IdentityCache:
+    def __init__(self, filename, source, destination, read_only=False):
+        """Load the identities for migrating from source to destination.
+
+        source, destination -- Names the servers (see server_name); if they
+            don't match the cache, it starts empty.
+        read_only -- Don't save new entries (eg: when the destination ids are
+            only references to a plan).
+        """
+        self._filename = filename
+        self._header = {'source':source, 'destination':destination}
+        self._read_only = read_only
+        self._maps = {}
+        self._file = None
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self._filename):
+            return
+        lines = open(self._filename, 'r').read().splitlines()
+        if not lines:
+            return
+        if json.loads(lines[0]) != self._header:
+            logging.warning("Replacing identity cache %s, as it was created for "
+                    "a different source or destination.", self._filename)
+            self._save()
+            return
+        for line in lines[1:]:
+            try:
+                kind, key, value = json.loads(line)
+            except ValueError:
+                # The last entry may be incomplete if we were interrupted.
+                logging.warning('Ignoring incomplete entry in %s.', self._filename)
+                break
+            self._maps.setdefault(kind, {})[key] = value
+        logging.info('Loaded %i identities from %s.', sum(len(m) for m in
+            self._maps.values()), self._filename)
+
+    def _save(self):
+        """Atomically rewrite the cache with the current entries."""
+        if self._read_only:
+            return
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        temp = self._filename + '.tmp'
+        output = open(temp, 'w')
+        output.write(json.dumps(self._header) + '\n')
+        for kind, entries in sorted(self._maps.items()):
+            for key, value in sorted(entries.items()):
+                output.write(json.dumps([kind, key, value]) + '\n')
+        output.close()
+        os.rename(temp, self._filename)
+
+    def get(self, kind):
+        """Get a copy of the entries of a kind (eg: 'ixPerson')."""
+        return dict(self._maps.get(kind, {}))
+
+    def lookup(self, kind, key):
+        return self._maps.get(kind, {}).get(key)
+
+    def add(self, kind, key, value):
+        self._lock.acquire()
+        try:
+            entries = self._maps.setdefault(kind, {})
+            if entries.get(key) == value:
+                return
+            if not self._read_only and self._file is None:
+                if not os.path.exists(self._filename):
+                    self._save()
+                self._file = open(self._filename, 'a')
+            entries[key] = value
+            if not self._read_only:
+                self._file.write(json.dumps([kind, key, value]) + '\n')
+                self._file.flush()
+        finally:
+            self._lock.release()
+
+    def validate(self, kind, ids):
+        """Remove the entries of a kind whose values aren't in ids.
+
+        ids -- The ids that currently exist in the destination.
+        """
+        ids = set(ids)
+        entries = self._maps.get(kind, {})
+        stale = [key for key, value in entries.items() if value not in ids]
+        for key in stale:
+            del entries[key]
+        if stale:
+            logging.info('Removing %i %s identities that are no longer in the '
+                    'destination.', len(stale), kind)
+            self._save()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -0,0 +1,105 @@
+#   Copyright (C) 2010 Henry Ludemann <misc@hl.id.au>
+#
+#   This file is part of the fogbugz import/export library.
+#
+#   The fogbugz import/export library is free software; you can redistribute it
+#   and/or modify it under the terms of the GNU Lesser General Public
+#   License as published by the Free Software Foundation; either
+#   version 2.1 of the License, or (at your option) any later version.
+#
+#   The fogbugz import/export library is distributed in the hope that it will be
+#   useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+#   of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#   Lesser General Public License for more details.
+#
+#   You should have received a copy of the GNU Lesser General Public
+#   License along with this library; if not, see
+#   <http://www.gnu.org/licenses/>.
+
+import cPickle
+import heapq
+import logging
+import tempfile
+
+class _SpilledStream:
+    """The remainder of a stream that has been written to a temporary file."""
+    def __init__(self, spill, offset, count):
+        self._spill = spill
+        self._offset = offset
+        self._count = count
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if not self._count:
+            raise StopIteration()
+        self._spill.seek(self._offset)
+        item = cPickle.load(self._spill)
+        self._offset = self._spill.tell()
+        self._count -= 1
+        return item
+
+def _spill(spill, stream):
+    spill.seek(0, 2)
+    offset = spill.tell()
+    count = 0
+    for item in stream:
+        cPickle.dump(item, spill, 2)
+        count += 1
+    return _SpilledStream(spill, offset, count)
+
+def _next_stream(streams):
+    """Get the (first item, remaining items) of the next non-empty stream."""
+    for stream in streams:
+        stream = iter(stream)
+        for first in stream:
+            return first, stream
+    return None
+
+def merge(streams, key, max_open=10000):
+    """Merge a number of sorted streams, yielding the items in key order.
+
+    Each stream must be sorted by key, and the streams must be in the order of
+    the key of their first item. A stream isn't started until the merge reaches
+    its first item, so only the streams that are currently 'open' are held.
+
+    streams -- An iterable of iterables.
+    key -- A function returning the sort key of an item.
+    max_open -- Once there are this many open streams, the remainder of newly
+        opened streams are spilled to a temporary file.
+    """
+    streams = iter(streams)
+    heap = []
+    spill = None
+    sequence = 0
+    last_start = None
+    pending = _next_stream(streams)
+    while heap or pending is not None:
+        if pending is not None:
+            first, rest = pending
+            start = key(first)
+            if not heap or start <= heap[0][0]:
+                # The next stream starts before anything we have; open it.
+                if last_start is not None and start < last_start:
+                    raise ValueError('Streams are not sorted by their first item '
+                            '(%s is before %s)!' % (start, last_start))
+                last_start = start
+                if len(heap) >= max_open:
+                    if spill is None:
+                        logging.info('More than %i open streams; spilling to disk.', max_open)
+                        spill = tempfile.TemporaryFile()
+                    rest = _spill(spill, rest)
+                heapq.heappush(heap, (start, sequence, first, rest))
+                sequence += 1
+                pending = _next_stream(streams)
+                continue
+
+        current, ignored, item, rest = heapq.heappop(heap)
+        yield item
+        for item in rest:
+            heapq.heappush(heap, (key(item), sequence, item, rest))
+            sequence += 1
+            break
+    if spill is not None:
+        spill.close()
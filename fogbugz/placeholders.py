@@ -0,0 +1,101 @@
+#   Copyright (C) 2010 Henry Ludemann <misc@hl.id.au>
+#
+#   This file is part of the fogbugz import/export library.
+#
+#   The fogbugz import/export library is free software; you can redistribute it
+#   and/or modify it under the terms of the GNU Lesser General Public
+#   License as published by the Free Software Foundation; either
+#   version 2.1 of the License, or (at your option) any later version.
+#
+#   The fogbugz import/export library is distributed in the hope that it will be
+#   useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+#   of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#   Lesser General Public License for more details.
+#
+#   You should have received a copy of the GNU Lesser General Public
+#   License along with this library; if not, see
+#   <http://www.gnu.org/licenses/>.
+
+"""Placeholder bugs, which keep the fogbugz ids in step with the roundup ids.
+
+Fogbugz allocates case numbers itself, so a placeholder bug is created for
+each roundup id without an issue, then resolved and closed.
+"""
+
+import logging
+import Queue
+import sys
+import threading
+
+def missing_ids(issues):
+    """Get the roundup ids that don't have an issue (issues must be sorted)."""
+    ids = set(int(issue.id) for issue in issues)
+    return [i for i in range(1, int(issues[-1].id)) if i not in ids] if issues else []
+
+class PlaceholderCloser:
+    """Resolve and close placeholder bugs off the critical path.
+
+    Only the 'new' of a placeholder needs to happen in order (to allocate the
+    id). If threaded, the placeholders are resolved and closed by a background
+    thread as they are created; otherwise it happens when finish() is called.
+    """
+    def __init__(self, connection, threaded=False):
+        self._connection = connection
+        self._ixbugs = []
+        self._queue = None
+        self._error = None
+        if threaded:
+            self._queue = Queue.Queue()
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _close(self, ixbug):
+        self._connection.post('resolve', {'ixBug':ixbug}, [])
+        self._connection.post('close', {'ixBug':ixbug}, [])
+
+    def _run(self):
+        try:
+            while 1:
+                ixbug = self._queue.get()
+                if ixbug is None:
+                    break
+                self._close(ixbug)
+        except BaseException, ex:
+            # Keep the error for finish(); the verification will show which
+            # placeholders weren't closed.
+            self._error = ex
+
+    def add(self, ixbug):
+        self._ixbugs.append(ixbug)
+        if self._queue is not None:
+            self._queue.put(ixbug)
+
+    def finish(self):
+        """Wait for the placeholders to be closed, returning their ixBugs."""
+        if self._queue is not None:
+            self._queue.put(None)
+            self._thread.join()
+            if self._error is not None:
+                logging.error('Failed to close placeholder bugs: %s', self._error)
+        else:
+            for ixbug in self._ixbugs:
+                self._close(ixbug)
+        return self._ixbugs
+
+def verify_placeholders(ixbugs, connection, page_size=500):
+    """Check that all of the placeholder bugs have been closed."""
+    logging.info('Checking %i placeholder bugs are closed...', len(ixbugs))
+    found = set()
+    not_closed = []
+    for i in range(0, len(ixbugs), page_size):
+        page = ixbugs[i:i + page_size]
+        for case in connection.post('search', {'q':','.join(page),
+                'cols':'ixBug,fOpen'}).findall('cases/case'):
+            ixbug = case.find('ixBug').text
+            found.add(ixbug)
+            if case.find('fOpen').text != 'false':
+                not_closed.append(ixbug)
+    not_closed += [ixbug for ixbug in ixbugs if ixbug not in found]
+    if not_closed:
+        sys.exit('Placeholder bugs %s were not closed!' % ', '.join(not_closed))
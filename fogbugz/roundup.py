@@ -0,0 +1,211 @@
+#   Copyright (C) 2010 Henry Ludemann <misc@hl.id.au>
+#
+#   This file is part of the fogbugz import/export library.
+#
+#   The fogbugz import/export library is free software; you can redistribute it
+#   and/or modify it under the terms of the GNU Lesser General Public
+#   License as published by the Free Software Foundation; either
+#   version 2.1 of the License, or (at your option) any later version.
+#
+#   The fogbugz import/export library is distributed in the hope that it will be
+#   useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+#   of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#   Lesser General Public License for more details.
+#
+#   You should have received a copy of the GNU Lesser General Public
+#   License along with this library; if not, see
+#   <http://www.gnu.org/licenses/>.
+
+"""Read a roundup export.
+
+The classes of an export are loaded into compact Records (see load_class),
+and the history of an item is read from the class journal (see Journal).
+"""
+
+from array import array
+import cPickle
+import csv
+import logging
+import os.path
+import threading
+
+from fogbugz.snapshot import Snapshot
+
+class Record(object):
+    """A compact record holding one row of a roundup class.
+
+    Records are created with record_class. They use slots rather than a
+    dictionary, and like a namedtuple, _replace returns an updated copy."""
+    __slots__ = ()
+
+    def __init__(self, *values):
+        if len(values) != len(self.__slots__):
+            raise TypeError('%s expects %i values, got %i!' % (
+                self.__class__.__name__, len(self.__slots__), len(values)))
+        for name, value in zip(self.__slots__, values):
+            setattr(self, name, value)
+
+    def _replace(self, **changes):
+        result = self.__class__.__new__(self.__class__)
+        for name in self.__slots__:
+            setattr(result, name, changes.pop(name) if name in changes else getattr(self, name))
+        if changes:
+            raise ValueError('Unknown fields %s for %s!' % (changes.keys(), self.__class__.__name__))
+        return result
+
+    def _values(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __eq__(self, other):
+        return self.__class__ is other.__class__ and self._values() == other._values()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__, ', '.join('%s=%r' % (name, getattr(self, name))
+            for name in self.__slots__))
+
+_record_classes = {}
+
+def record_class(name, fields):
+    """Get the Record class for a roundup class with the given fields."""
+    key = (name, tuple(fields))
+    try:
+        return _record_classes[key]
+    except KeyError:
+        result = _record_classes[key] = type(name, (Record,), {'__slots__':key[1]})
+        return result
+
+# Lists of ids in these fields are shared between records. Other lists (eg:
+# the messages of an issue) are different for every issue.
+_shared_fields = frozenset(['keyword', 'nosy', 'superseder'])
+
+# The shared lists; the table is cleared when it gets this big, so an unusual
+# export can't grow it without bound.
+_interned = {}
+_interned_limit = 10000
+
+def intern_value(value, field=None):
+    """Share repeated ids between records.
+
+    Ids (eg: of users, statuses, keywords) are repeated in every issue and
+    every step of its history. Lists of ids are stored as tuples, which are
+    shared for the fields (eg: 'keyword') where they repeat."""
+    if isinstance(value, str):
+        return intern(value) if value.isdigit() else value
+    elif isinstance(value, list) and all(isinstance(v, str) and v.isdigit() for v in value):
+        value = tuple(intern(v) for v in value)
+        if field not in _shared_fields:
+            return value
+        try:
+            return _interned[value]
+        except KeyError:
+            if len(_interned) >= _interned_limit:
+                _interned.clear()
+            _interned[value] = value
+            return value
+    return value
+
+_snapshots = {}
+
+def _snapshot(dir):
+    """Get the snapshot of the classes in an export, stored beside it."""
+    filename = os.path.abspath(dir).rstrip(os.sep) + '.snapshot'
+    try:
+        return _snapshots[filename]
+    except KeyError:
+        result = _snapshots[filename] = Snapshot(filename)
+        return result
+
+def save_snapshots():
+    """Save the classes parsed since the snapshots were loaded (writing each
+    snapshot once)."""
+    for snapshot in _snapshots.values():
+        snapshot.save()
+
+def load_class(dir, name):
+    """Load the current state of a class from the issues csv.
+
+    Returns a Record for each item, with an attribute for each field in the
+    class. The parsed csv is kept in a snapshot beside the export, so later
+    runs don't have to parse it again (until the csv changes)."""
+    filename = os.path.join(dir, '%s.csv' % name)
+    stat = os.stat(filename)
+    snapshot = _snapshot(dir)
+    data = snapshot.get(name, stat)
+    if data is None:
+        logging.info('Parsing %s...', filename)
+        contents = csv.reader(open(filename), delimiter=':')
+        fields = [h.replace(' ', '_') for h in contents.next()]
+        data = fields, [[eval(c) for c in row] for row in contents]
+        snapshot.put(name, stat, data)
+    fields, rows = data
+    Class = record_class(name, fields)
+    for row in rows:
+        yield Class(*(intern_value(value, field) for field, value in zip(fields, row)))
+
+Change = record_class('Change', ['id', 'timestamp', 'user_id', 'action', 'items'])
+
+class Journal:
+    '''The journal for a given class, indexed by item id.
+
+    Rather than loading the whole journal, we record the byte offset of each
+    item's rows, and only decode the rows of the item being asked for. The
+    index is cached beside the journal, and rebuilt when the journal changes.'''
+    def __init__(self, dir, name):
+        self._filename = os.path.join(dir, '%s-journals.csv' % name)
+        self._index_filename = os.path.join(dir, '%s-journals.index' % name)
+        self._journal = open(self._filename, 'rb')
+        self._index = self._load_index()
+        # The journal may be read from several threads.
+        self._lock = threading.Lock()
+
+    def _load_index(self):
+        stat = os.stat(self._filename)
+        try:
+            mtime, size, index = cPickle.load(open(self._index_filename, 'rb'))
+            if (mtime, size) == (stat.st_mtime, stat.st_size):
+                return index
+        except (IOError, EOFError, ValueError, cPickle.UnpicklingError):
+            pass
+
+        logging.info('Indexing %s...', self._filename)
+        index = {}
+        journal = self._journal
+        journal.seek(0)
+        while 1:
+            # The values are stored as python repr's, so each row is on a
+            # single line.
+            offset = journal.tell()
+            line = journal.readline()
+            if not line:
+                break
+            id = eval(csv.reader([line], delimiter=':').next()[0])
+            index.setdefault(id, array('l')).append(offset)
+        try:
+            cPickle.dump((stat.st_mtime, stat.st_size, index),
+                    open(self._index_filename, 'wb'), 2)
+        except IOError, ex:
+            logging.warning('Unable to cache the journal index (%s).', ex)
+        return index
+
+    def __getitem__(self, id):
+        '''Get the list of changes for an item, in the order they were made.'''
+        self._lock.acquire()
+        try:
+            lines = []
+            for offset in self._index[id]:
+                self._journal.seek(offset)
+                lines.append(self._journal.readline())
+        finally:
+            self._lock.release()
+        return [Change(*(eval(f) for f in row))
+                for row in csv.reader(lines, delimiter=':')]
+
+def load_journal(dir, name):
+    '''Load the journal for a given class.
+
+    Returns a Journal, mapping id to a list of (id, timestamp, user, action,
+    contents) changes.'''
+    return Journal(dir, name)
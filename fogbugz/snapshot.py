@@ -0,0 +1,136 @@
+#   Copyright (C) 2010 Henry Ludemann <misc@hl.id.au>
+#
+#   This file is part of the fogbugz import/export library.
+#
+#   The fogbugz import/export library is free software; you can redistribute it
+#   and/or modify it under the terms of the GNU Lesser General Public
+#   License as published by the Free Software Foundation; either
+#   version 2.1 of the License, or (at your option) any later version.
+#
+#   The fogbugz import/export library is distributed in the hope that it will be
+#   useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+#   of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#   Lesser General Public License for more details.
+#
+#   You should have received a copy of the GNU Lesser General Public
+#   License along with this library; if not, see
+#   <http://www.gnu.org/licenses/>.
+
+"""A binary snapshot of parsed files, invalidated when the files change.
+
+The snapshot is a single file of marshalled sections (one per source file),
+preceded by a header recording the mtime & size of each source. The file is
+memory mapped, so loading a section only reads (and decodes) that section.
+New sections are kept in memory until they are saved (once, for all of them).
+"""
+
+import logging
+import marshal
+import mmap
+import os
+import struct
+
+SNAPSHOT_VERSION = 1
+
+_length = struct.Struct('<I')
+
+class Snapshot:
+    def __init__(self, filename):
+        self._filename = filename
+        self._sections = {}
+        self._pending = {}
+        self._map = None
+        self._load()
+
+    def _load(self):
+        try:
+            input = open(self._filename, 'rb')
+        except IOError:
+            return
+        try:
+            self._map = mmap.mmap(input.fileno(), 0, access=mmap.ACCESS_READ)
+            length, = _length.unpack(self._map[:_length.size])
+            version, sections = marshal.loads(self._map[_length.size:_length.size + length])
+            if version == SNAPSHOT_VERSION:
+                self._sections = sections
+        except (EnvironmentError, ValueError, EOFError, TypeError, struct.error):
+            logging.warning('Ignoring the invalid snapshot %s.', self._filename)
+            self._sections = {}
+        finally:
+            input.close()
+
+    def get(self, name, stat):
+        """Get the data of a section, or None if it is missing or out of date.
+
+        stat -- The os.stat of the file the section was parsed from.
+        """
+        if name in self._pending:
+            mtime, size, contents = self._pending[name]
+        elif name in self._sections:
+            mtime, size, offset, length = self._sections[name]
+            contents = self._map[offset:offset + length]
+        else:
+            return None
+        if (mtime, size) != (stat.st_mtime, stat.st_size):
+            return None
+        return marshal.loads(contents)
+
+    def put(self, name, stat, data):
+        """Store the data of a section (written to the snapshot by save).
+
+        stat -- The os.stat of the file before it was parsed.
+        data -- The parsed data; it can hold anything marshal can store.
+        """
+        try:
+            self._pending[name] = (stat.st_mtime, stat.st_size, marshal.dumps(data))
+        except ValueError, ex:
+            logging.warning('Unable to snapshot %s (%s).', name, ex)
+
+    def save(self):
+        """Rewrite the snapshot with the sections stored since it was loaded."""
+        if not self._pending:
+            return
+        sections = [(n, mtime, size, self._map[offset:offset + length])
+                for n, (mtime, size, offset, length) in self._sections.items()
+                if n not in self._pending]
+        sections.extend((n, mtime, size, contents)
+                for n, (mtime, size, contents) in self._pending.items())
+        self._pending = {}
+
+        # The header holds the offsets of the sections, which depend on the
+        # length of the header, so we find the length first.
+        def header(start):
+            index = {}
+            offset = start
+            for n, mtime, size, contents in sections:
+                index[n] = (mtime, size, offset, len(contents))
+                offset += len(contents)
+            return marshal.dumps((SNAPSHOT_VERSION, index))
+        start = _length.size + len(header(0))
+        index = header(start)
+        while _length.size + len(index) != start:
+            start = _length.size + len(index)
+            index = header(start)
+
+        temp = self._filename + '.tmp'
+        try:
+            output = open(temp, 'wb')
+            output.write(_length.pack(len(index)))
+            output.write(index)
+            for n, mtime, size, contents in sections:
+                output.write(contents)
+            output.close()
+            os.rename(temp, self._filename)
+        except EnvironmentError, ex:
+            logging.warning('Unable to save the snapshot %s (%s).', self._filename, ex)
+            return
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._sections = {}
+        self._load()
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
@@ -0,0 +1,91 @@
+#   Copyright (C) 2010 Henry Ludemann <misc@hl.id.au>
+#
+#   This file is part of the fogbugz import/export library.
+#
+#   The fogbugz import/export library is free software; you can redistribute it
+#   and/or modify it under the terms of the GNU Lesser General Public
+#   License as published by the Free Software Foundation; either
+#   version 2.1 of the License, or (at your option) any later version.
+#
+#   The fogbugz import/export library is distributed in the hope that it will be
+#   useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+#   of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#   Lesser General Public License for more details.
+#
+#   You should have received a copy of the GNU Lesser General Public
+#   License along with this library; if not, see
+#   <http://www.gnu.org/licenses/>.
+
+"""Measure the memory used by the changes from get_issues.
+
+Generates a large synthetic search result, and holds all of the changes
+from get_issues in memory (as a full migration would). Run with;
+
+  python -m fogbugz.test.benchexport [cases] [events per case]
+"""
+
+import gc
+import random
+import sys
+import time
+
+from fogbugz.connection import MockConnection
+from fogbugz.export import get_issues
+
+_projects = ['Project %i' % i for i in range(10)]
+_tags = ['tag%i' % i for i in range(20)]
+
+def _event(rand, ixbug, i, changes):
+    return ('<event ixBug="%i"><sVerb>Edited</sVerb><ixPerson>%i</ixPerson>'
+            '<ixPersonAssignedTo>%i</ixPersonAssignedTo><dt>2010-%02i-%02iT%02i:%02i:00Z</dt>'
+            '<s>%s</s><sChanges>%s</sChanges><rgAttachments /></event>' % (
+                ixbug, rand.randint(2, 30), rand.randint(2, 30), 1 + ixbug % 12,
+                1 + i // 24, i % 24, i, 'A message for event %i' % i if i % 3 == 0 else '',
+                '\n'.join(changes)))
+
+def synthetic_search(cases, events, seed=1):
+    rand = random.Random(seed)
+    xml = ['<response><cases count="%i">' % cases]
+    for ixbug in range(1, cases + 1):
+        tags = rand.sample(_tags, 3)
+        project = rand.choice(_projects)
+        xml.append('<case ixBug="%i"><ixBug>%i</ixBug><sProject>%s</sProject>'
+                '<sTitle>Case number %i</sTitle><ixPriority>3</ixPriority>'
+                '<ixBugParent>0</ixBugParent><sStatus>Active</sStatus>'
+                '<sCategory>Bug</sCategory><ixPersonAssignedTo>%i</ixPersonAssignedTo>'
+                '<dtOpened>2010-%02i-01T00:00:00Z</dtOpened>'
+                '<tags>%s</tags><events>' % (ixbug, ixbug, project, ixbug,
+                    rand.randint(2, 30), 1 + ixbug % 12, ''.join('<tag>%s</tag>' % t for t in tags)))
+        xml.append(_event(rand, ixbug, 0, []))
+        for i in range(1, events):
+            changes = []
+            if i == events - 1:
+                changes.append("Added tags '%s'." % tags[0])
+            elif i % 4 == 1:
+                changes.append("Project changed from 'Project X' to '%s'." % project)
+            elif i % 4 == 2:
+                changes.append("Priority changed from '2 - High' to '3 - Normal'")
+            xml.append(_event(rand, ixbug, i, changes))
+        xml.append('</events></case>')
+    xml.append('</cases></response>')
+    return ''.join(xml)
+
+def _rss():
+    return int(open('/proc/self/statm').read().split()[1]) * 4096 / 1024.0 / 1024
+
+def benchmark(cases, events):
+    source = MockConnection(search=synthetic_search(cases, events))
+    gc.collect()
+    start_rss = _rss()
+    start = time.time()
+    issues = list(get_issues(source, None))
+    elapsed = time.time() - start
+    gc.collect()
+    changes = sum(len(changes) for changes in issues)
+    memory = _rss() - start_rss
+    print '%i changes for %i cases in %.2fs; %.1f MB (%i bytes per change)' % (
+            changes, cases, elapsed, memory, memory * 1024 * 1024 / changes)
+
+if __name__ == '__main__':
+    benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 5000,
+            int(sys.argv[2]) if len(sys.argv) > 2 else 20)
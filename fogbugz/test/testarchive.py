@@ -0,0 +1,133 @@
+#   Copyright (C) 2010 Henry Ludemann <misc@hl.id.au>
+#
+#   This file is part of the fogbugz import/export library.
+#
+#   The fogbugz import/export library is free software; you can redistribute it
+#   and/or modify it under the terms of the GNU Lesser General Public
+#   License as published by the Free Software Foundation; either
+#   version 2.1 of the License, or (at your option) any later version.
+#
+#   The fogbugz import/export library is distributed in the hope that it will be
+#   useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+#   of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#   Lesser General Public License for more details.
+#
+#   You should have received a copy of the GNU Lesser General Public
+#   License along with this library; if not, see
+#   <http://www.gnu.org/licenses/>.
+
+import os.path
+import shutil
+import tempfile
+import unittest
+
+from fogbugz.archive import Archive, ArchiveConnection, CASE, export_archive
+from fogbugz.connection import MockConnection, ElementTree
+from fogbugz.export import get_issues, ExportError
+from fogbugz.verify import fetch_digests
+
+class SourceConnection(MockConnection):
+    def __init__(self, xml_filename):
+        dir = os.path.dirname(__file__)
+        MockConnection.__init__(self, search=open(os.path.join(dir, xml_filename), 'r').read())
+        self.attachments = []
+
+    def _post(self, args, files=[]):
+        if args['cmd'] == 'listPeople':
+            return '<response><people><person><ixPerson>2</ixPerson>' \
+                    '<sFullName>Sally</sFullName></person></people></response>'
+        return MockConnection._post(self, args, files)
+
+    def get_attachment(self, path):
+        self.attachments.append(path)
+        return 'contents of %s' % path
+
+class ColumnsConnection(SourceConnection):
+    """Only returns the columns a search asks for (like fogbugz does)."""
+    def _post(self, args, files=[]):
+        if args['cmd'] != 'search':
+            return SourceConnection._post(self, args, files)
+        columns = set(['ixBug'] + args['cols'].split(','))
+        response = ElementTree.fromstring(self._search)
+        for case in response.findall('cases/case'):
+            for name, value in [('sPersonAssignedTo', 'Sally'),
+                    ('dtOpened', '2010-01-01T00:00:00Z')]:
+                ElementTree.SubElement(case, name).text = value
+            for child in list(case):
+                if child.tag not in columns:
+                    case.remove(child)
+        return ElementTree.tostring(response)
+
+class TestArchive(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, 'export.archive')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_export_and_serve(self):
+        source = SourceConnection('tags_and_attachments.xml')
+        export_archive(source, None, self.filename)
+        self.assertEqual(1, len(source.attachments))
+
+        archive = ArchiveConnection(self.filename)
+        self.assertEqual(list(get_issues(source, None)), list(get_issues(archive, None)))
+        self.assertEqual('contents of %s' % source.attachments[0],
+                archive.get_attachment(source.attachments[0]))
+        self.assertEqual('Sally', archive.post('listPeople', {}).find('people/person/sFullName').text)
+        self.assertEqual(1, len(archive.post('search', {'q':'5'}).findall('cases/case')))
+        self.assertEqual(0, len(archive.post('search', {'q':'6'}).findall('cases/case')))
+
+    def test_append(self):
+        export_archive(SourceConnection('tags_and_attachments.xml'), None, self.filename)
+        export_archive(SourceConnection('resolve_and_close.xml'), None, self.filename)
+        archive = ArchiveConnection(self.filename)
+        self.assertEqual(['5', '94'], [case.find('ixBug').text
+            for case in archive.post('search', {}).findall('cases/case')])
+
+    def test_verify_digests(self):
+        source = ColumnsConnection('tags_and_attachments.xml')
+        export_archive(source, None, self.filename)
+        archive = ArchiveConnection(self.filename)
+        self.assertEqual(list(fetch_digests([source], ['5'])),
+                list(fetch_digests([archive], ['5'])))
+
+        # Archives without the digest columns can't be verified.
+        archive = Archive(self.filename)
+        archive.put(CASE, '5', '<case><ixBug>5</ixBug></case>')
+        archive.close()
+        self.assertRaises(ExportError, list, fetch_digests([ArchiveConnection(self.filename)], ['5']))
+
+    def test_incomplete_record(self):
+        archive = Archive(self.filename)
+        archive.put(CASE, '1', '<case>first</case>')
+        archive.close()
+        size = os.path.getsize(self.filename)
+        archive = Archive(self.filename)
+        archive.put(CASE, '2', '<case>second</case>')
+        archive.close()
+        complete = open(self.filename, 'rb').read()
+
+        # Truncate the second record in its header, key and data.
+        for length in [size + 3, size + 10, len(complete) - 1]:
+            open(self.filename, 'wb').write(complete[:length])
+            archive = Archive(self.filename)
+            self.assertEqual(['1'], archive.keys(CASE))
+            self.assertEqual(size, os.path.getsize(self.filename))
+            archive.put(CASE, '3', '<case>third</case>')
+            archive.close()
+            archive = Archive(self.filename)
+            self.assertEqual('<case>third</case>', archive.get(CASE, '3'))
+            archive.close()
+
+    def test_later_records_replace_earlier(self):
+        archive = Archive(self.filename)
+        archive.put(CASE, '1', '<case>old</case>')
+        archive.put(CASE, '1', '<case>new</case>')
+        archive.close()
+        self.assertEqual('<case>new</case>', Archive(self.filename).get(CASE, '1'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+#   Copyright (C) 2010 Henry Ludemann <misc@hl.id.au>
+#
+#   This file is part of the fogbugz import/export library.
+#
+#   The fogbugz import/export library is free software; you can redistribute it
+#   and/or modify it under the terms of the GNU Lesser General Public
+#   License as published by the Free Software Foundation; either
+#   version 2.1 of the License, or (at your option) any later version.
+#
+#   The fogbugz import/export library is distributed in the hope that it will be
+#   useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+#   of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#   Lesser General Public License for more details.
+#
+#   You should have received a copy of the GNU Lesser General Public
+#   License along with this library; if not, see
+#   <http://www.gnu.org/licenses/>.
+
+import unittest
+
+from fogbugz.coalesce import Coalescer
+
+def change(cmd, dt, person='1', message=None, files=[], **fields):
+    params = {'dt':dt, 'ixPerson':person, 'sTitle':'Title', 'sTags':''}
+    params.update(fields)
+    if message:
+        params['sEvent'] = message
+    return cmd, params, files
+
+class TestCoalescer(unittest.TestCase):
+    def coalesce(self, *commands):
+        self.coalescer = Coalescer(10, 'ixPerson', lambda params:params['dt'],
+                separate=['ixBugParent'])
+        return list(self.coalescer.coalesce(commands))
+
+    def test_merge_burst(self):
+        commands = self.coalesce(
+                change('new', 0, message='Created'),
+                change('edit', 5, files=[('a.txt', 'a')]),
+                change('edit', 8, sTags='x'),
+                change('resolve', 12, sTags='x', sTitle='Fixed'))
+        # The tags set by the 'new' would be lost if the edit was merged.
+        self.assertEqual([change('new', 0, message='Created', files=[('a.txt', 'a')]),
+            change('resolve', 8, sTags='x', sTitle='Fixed')], commands)
+        self.assertEqual((4, 2, 0), (self.coalescer.requests,
+            self.coalescer.merged, self.coalescer.dropped))
+
+    def test_nothing_lost(self):
+        commands = [
+                change('new', 0),
+                # Changes a field set by the 'new'.
+                change('edit', 1, sTitle='Other'),
+                # A different person.
+                change('edit', 2, '2', sTags='x'),
+                # Outside the window.
+                change('edit', 20, sTags='y'),
+                # Both have messages.
+                change('edit', 21, message='One', sTitle='Again'),
+                change('edit', 22, message='Two', sTags='z', sTitle='Again'),
+                # Changes the same field twice.
+                change('edit', 23, message='Two', sTags='w', sTitle='Again'),
+                # Sets the parent.
+                change('edit', 40, sTags='w', sTitle='Again', ixBugParent='3'),
+                change('edit', 41, sTags='w', sTitle='Again', ixBugParent='4'),
+                # Both change the status.
+                change('resolve', 60, sTags='w', sTitle='Again', ixBugParent='4'),
+                change('close', 61, sTags='w', sTitle='Again', ixBugParent='4'),
+                ]
+        self.assertEqual(commands, self.coalesce(*commands))
+
+    def test_drop_unchanged(self):
+        commands = self.coalesce(
+                change('new', 0),
+                change('edit', 100, '2'),
+                change('edit', 200, '2', files=[('a.txt', 'a')]),
+                ('close', {}, []))
+        self.assertEqual([change('new', 0),
+            change('edit', 200, '2', files=[('a.txt', 'a')]),
+            ('close', {}, [])], commands)
+        self.assertEqual((4, 0, 1), (self.coalescer.requests,
+            self.coalescer.merged, self.coalescer.dropped))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -16,17 +16,58 @@
 #   License along with this library; if not, see
 #   <http://www.gnu.org/licenses/>.
 
+import multiprocessing
 import os.path
+import re
+import threading
 import unittest
 
-from fogbugz.connection import MockConnection
-from fogbugz.export import get_issues
+from fogbugz.connection import MockConnection, ElementTree
+import fogbugz.export
+from fogbugz.export import get_issues, get_issues_sharded, Change, ExportError
+from fogbugz.test.benchexport import synthetic_search
 
 def connection(xml_filename):
     dir = os.path.dirname(__file__)
     filename = os.path.join(dir, xml_filename)
     return MockConnection(search=open(filename, 'r').read())
 
+class ShardedConnection(MockConnection):
+    """Answers searches for lists of case numbers, failing the first few."""
+    def __init__(self, search, failures=0):
+        MockConnection.__init__(self, search=search)
+        self.failures = failures
+        self.loaded = []
+        self._lock = threading.Lock()
+        self.cases = dict((case.find('ixBug').text, ElementTree.tostring(case))
+                for case in ElementTree.fromstring(search).findall('cases/case'))
+
+    def _post(self, args, files=[]):
+        search = args.get('q')
+        if args['cmd'] != 'search' or not search or not re.match('^[0-9,]+$', search):
+            return MockConnection._post(self, args, files)
+        self._lock.acquire()
+        try:
+            if self.failures:
+                self.failures -= 1
+                return '<response><error code="1">Timed out</error></response>'
+            self.loaded.append(search)
+        finally:
+            self._lock.release()
+        return '<response><cases>%s</cases></response>' % ''.join(
+                self.cases[ixbug] for ixbug in search.split(','))
+
+class GatedConnection(ShardedConnection):
+    """Answers the first search for case numbers, then waits for the gate."""
+    def __init__(self, search):
+        self.gate = threading.Event()
+        ShardedConnection.__init__(self, search)
+
+    def _post(self, args, files=[]):
+        if getattr(self, 'loaded', None) and re.match('^[0-9,]+$', args.get('q') or ''):
+            self.gate.wait()
+        return ShardedConnection._post(self, args, files)
+
 class TestFogbugzExport(unittest.TestCase):
     def test_tags_attachments(self):
         source = connection('tags_and_attachments.xml')
@@ -87,6 +128,70 @@ class TestFogbugzExport(unittest.TestCase):
             'sProject': 'USA - Data', 'ixPerson': '7', 'sStatus': 'Active'},
             changes[2])
 
+    def test_sharded(self):
+        search = synthetic_search(30, 6)
+        source = ShardedConnection(search)
+        for sort in [False, True]:
+            connections = [ShardedConnection(search, failures=1) for i in range(3)]
+            self.assertEqual(list(get_issues(source, None, sort)),
+                    list(get_issues_sharded(source, connections, None, 4, sort)))
+            # Each connection that loaded a shard failed the first time.
+            self.assertEqual(4, sum(len(c.loaded) for c in connections))
+            self.assertEqual([], [c.failures for c in connections if c.loaded and c.failures])
+
+    def test_sorted_sharded_streams(self):
+        connection = GatedConnection(synthetic_search(30, 6))
+        expected = list(get_issues(connection, None, sort=True))
+        issues = get_issues_sharded(connection, [connection], None, 5, sort=True)
+        # The first issues are yielded while the later shards are still loading.
+        self.assertEqual(expected[0], issues.next())
+        self.assertEqual(1, len(connection.loaded))
+        connection.gate.set()
+        self.assertEqual(expected[1:], list(issues))
+
+    def test_sorted(self):
+        source = MockConnection(search=synthetic_search(30, 6))
+        opened = lambda issue:(issue[-1]['dt'], int(issue[-1]['ixBug']))
+        self.assertEqual(sorted(get_issues(source, None), key=opened),
+                list(get_issues(source, None, sort=True)))
+
+    def test_process_pool(self):
+        source = MockConnection(search=synthetic_search(30, 6))
+        for sort in [False, True]:
+            serial = list(get_issues(source, None, sort))
+            self.assertEqual(serial, list(get_issues(source, None, sort,
+                processes=2, chunksize=4)))
+        unordered = list(get_issues(source, None, processes=2, chunksize=4,
+            ordered=False))
+        key = lambda issue:int(issue[0]['ixBug'])
+        self.assertEqual(sorted(serial, key=key), sorted(unordered, key=key))
+        self.assertEqual([], multiprocessing.active_children())
+
+    def test_process_pool_closed_early(self):
+        source = MockConnection(search=synthetic_search(30, 6))
+        issues = get_issues(source, None, processes=2, chunksize=4)
+        self.assertEqual(list(get_issues(source, None))[0], issues.next())
+        issues.close()
+        self.assertEqual([], multiprocessing.active_children())
+
+    def test_sharded_gives_up(self):
+        source = ShardedConnection(synthetic_search(5, 2), failures=10)
+        issues = get_issues_sharded(source, [source], None, 2, retries=1)
+        self.assertRaises(ExportError, list, issues)
+
+    def test_interned_values(self):
+        a, b = Change([('sStatus', 'Active')]), Change([('sStatus', 'Act' + 'ive')])
+        self.assertTrue(a['sStatus'] is b['sStatus'])
+        limit = fogbugz.export._interned_limit
+        fogbugz.export._interned_limit = 3
+        try:
+            for i in range(10):
+                change = Change([('tags', ['tag%i' % i])])
+                self.assertEqual(frozenset(['tag%i' % i]), change['tags'])
+                self.assertTrue(len(fogbugz.export._interned) <= 3)
+        finally:
+            fogbugz.export._interned_limit = limit
+
 
 if __name__ == '__main__':
     import logging
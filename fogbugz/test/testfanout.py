@@ -0,0 +1,76 @@
+#   Copyright (C) 2010 Henry Ludemann <misc@hl.id.au>
+#
+#   This file is part of the fogbugz import/export library.
+#
+#   The fogbugz import/export library is free software; you can redistribute it
+#   and/or modify it under the terms of the GNU Lesser General Public
+#   License as published by the Free Software Foundation; either
+#   version 2.1 of the License, or (at your option) any later version.
+#
+#   The fogbugz import/export library is distributed in the hope that it will be
+#   useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+#   of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#   Lesser General Public License for more details.
+#
+#   You should have received a copy of the GNU Lesser General Public
+#   License along with this library; if not, see
+#   <http://www.gnu.org/licenses/>.
+
+
+import threading
+import unittest
+
+from fogbugz.fanout import fan_out
+
+class TestFanOut(unittest.TestCase):
+    def test_in_order(self):
+        first, second = [], []
+        errors = fan_out(range(100), [('first', first.append),
+            ('second', second.append)], buffer_size=5)
+        self.assertEqual({}, errors)
+        self.assertEqual(range(100), first)
+        self.assertEqual(range(100), second)
+
+    def test_failure_doesnt_stop_others(self):
+        received = []
+        def fail(item):
+            if item == 3:
+                raise ValueError('Failed on 3')
+        errors = fan_out(range(10), [('bad', fail), ('good', received.append)],
+                buffer_size=1)
+        self.assertEqual(['bad'], errors.keys())
+        self.assertEqual(range(10), received)
+
+    def test_all_failed(self):
+        produced = []
+        def items():
+            for i in range(1000):
+                produced.append(i)
+                yield i
+        def fail(item):
+            raise ValueError('Failed')
+        errors = fan_out(items(), [('bad', fail)], buffer_size=1)
+        self.assertEqual(['bad'], errors.keys())
+        self.assertTrue(len(produced) < 1000)
+
+    def test_bounded_buffer(self):
+        # A blocked consumer holds up the producer once its buffer is full.
+        release = threading.Event()
+        produced = []
+        def items():
+            for i in range(10):
+                produced.append(i)
+                yield i
+        def slow(item):
+            release.wait()
+        thread = threading.Thread(target=fan_out, args=(items(), [('slow', slow)], 2))
+        thread.start()
+        thread.join(0.5)
+        # One item being processed, and two in the queue.
+        self.assertEqual(4, len(produced))
+        release.set()
+        thread.join()
+        self.assertEqual(10, len(produced))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+#   Copyright (C) 2010 Henry Ludemann <misc@hl.id.au>
+#
+#   This file is part of the fogbugz import/export library.
+#
+#   The fogbugz import/export library is free software; you can redistribute it
+#   and/or modify it under the terms of the GNU Lesser General Public
+#   License as published by the Free Software Foundation; either
+#   version 2.1 of the License, or (at your option) any later version.
+#
+#   The fogbugz import/export library is distributed in the hope that it will be
+#   useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+#   of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#   Lesser General Public License for more details.
+#
+#   You should have received a copy of the GNU Lesser General Public
+#   License along with this library; if not, see
+#   <http://www.gnu.org/licenses/>.
+
+import random
+import unittest
+
+from fogbugz.merge import merge
+
+def _key(change):
+    return change['dt'], int(change['ixBug'])
+
+class TestMerge(unittest.TestCase):
+    def _issues(self, count):
+        rand = random.Random(4)
+        issues = []
+        for ixbug in range(1, count + 1):
+            dt = rand.randint(0, 1000)
+            changes = []
+            for i in range(rand.randint(1, 5)):
+                changes.append({'ixBug':str(ixbug), 'dt':'%04i' % dt, 'n':i})
+                dt += rand.randint(0, 100)
+            issues.append(changes)
+        issues.sort(key=lambda changes:_key(changes[0]))
+        return issues
+
+    def _check(self, max_open):
+        issues = self._issues(200)
+        expected = sorted((c for changes in issues for c in changes), key=_key)
+        result = list(merge((iter(c) for c in issues), _key, max_open))
+        self.assertEqual(expected, result)
+
+    def test_merge(self):
+        self._check(10000)
+
+    def test_spill(self):
+        self._check(3)
+
+    def test_empty_streams(self):
+        self.assertEqual([1, 2, 3], list(merge([[], [1, 3], [], [2]], lambda x:x)))
+
+    def test_unsorted_streams(self):
+        self.assertRaises(ValueError, list, merge([[5], [1]], lambda x:x))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+#   Copyright (C) 2010 Henry Ludemann <misc@hl.id.au>
+#
+#   This file is part of the fogbugz import/export library.
+#
+#   The fogbugz import/export library is free software; you can redistribute it
+#   and/or modify it under the terms of the GNU Lesser General Public
+#   License as published by the Free Software Foundation; either
+#   version 2.1 of the License, or (at your option) any later version.
+#
+#   The fogbugz import/export library is distributed in the hope that it will be
+#   useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+#   of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#   Lesser General Public License for more details.
+#
+#   You should have received a copy of the GNU Lesser General Public
+#   License along with this library; if not, see
+#   <http://www.gnu.org/licenses/>.
+
+
+import threading
+import unittest
+
+from fogbugz.connection import MockConnection
+from fogbugz.placeholders import PlaceholderCloser, missing_ids, verify_placeholders
+
+class Issue:
+    def __init__(self, id):
+        self.id = id
+
+class PlaceholderConnection(MockConnection):
+    """Records the resolved & closed bugs, and answers searches for them."""
+    def __init__(self, fail=None):
+        MockConnection.__init__(self)
+        self.posts = []
+        self.closed = set()
+        self.fail = fail
+        self.threads = set()
+
+    def _post(self, args, files=[]):
+        cmd = args['cmd']
+        if cmd in ('resolve', 'close'):
+            self.threads.add(threading.current_thread())
+            if args['ixBug'] == self.fail:
+                raise IOError('Connection reset')
+            self.posts.append((cmd, args['ixBug']))
+            if cmd == 'close':
+                self.closed.add(args['ixBug'])
+        elif cmd == 'search':
+            return '<response><cases>%s</cases></response>' % ''.join(
+                    '<case><ixBug>%s</ixBug><fOpen>%s</fOpen></case>' % (ixbug,
+                        'false' if ixbug in self.closed else 'true')
+                    for ixbug in args['q'].split(',') if ixbug != '404')
+        return MockConnection._post(self, args, files)
+
+class TestPlaceholders(unittest.TestCase):
+    def test_missing_ids(self):
+        self.assertEqual([1, 3, 4], missing_ids([Issue('2'), Issue('5'), Issue('6')]))
+        self.assertEqual([], missing_ids([Issue('1'), Issue('2')]))
+        self.assertEqual([], missing_ids([]))
+
+    def test_close_at_finish(self):
+        connection = PlaceholderConnection()
+        closer = PlaceholderCloser(connection)
+        closer.add('10')
+        closer.add('11')
+        self.assertEqual([], connection.posts)
+        self.assertEqual(['10', '11'], closer.finish())
+        self.assertEqual([('resolve', '10'), ('close', '10'), ('resolve', '11'),
+            ('close', '11')], connection.posts)
+        verify_placeholders(['10', '11'], connection, page_size=1)
+
+    def test_threaded(self):
+        connection = PlaceholderConnection()
+        closer = PlaceholderCloser(connection, threaded=True)
+        for ixbug in ['10', '11', '12']:
+            closer.add(ixbug)
+        self.assertEqual(['10', '11', '12'], closer.finish())
+        self.assertEqual(set(['10', '11', '12']), connection.closed)
+        self.assertFalse(threading.current_thread() in connection.threads)
+        self.assertFalse(closer._thread.is_alive())
+        verify_placeholders(['10', '11', '12'], connection)
+
+    def test_threaded_error(self):
+        connection = PlaceholderConnection(fail='11')
+        closer = PlaceholderCloser(connection, threaded=True)
+        for ixbug in ['10', '11', '12']:
+            closer.add(ixbug)
+        # The error is logged, and the verification finds the open bugs.
+        self.assertEqual(['10', '11', '12'], closer.finish())
+        self.assertFalse(closer._thread.is_alive())
+        self.assertEqual(set(['10']), connection.closed)
+        self.assertRaises(SystemExit, verify_placeholders, ['10', '11', '12'], connection)
+
+    def test_verify_missing_bug(self):
+        connection = PlaceholderConnection()
+        connection.closed.add('404')
+        self.assertRaises(SystemExit, verify_placeholders, ['404'], connection)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+#   Copyright (C) 2010 Henry Ludemann <misc@hl.id.au>
+#
+#   This file is part of the fogbugz import/export library.
+#
+#   The fogbugz import/export library is free software; you can redistribute it
+#   and/or modify it under the terms of the GNU Lesser General Public
+#   License as published by the Free Software Foundation; either
+#   version 2.1 of the License, or (at your option) any later version.
+#
+#   The fogbugz import/export library is distributed in the hope that it will be
+#   useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+#   of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#   Lesser General Public License for more details.
+#
+#   You should have received a copy of the GNU Lesser General Public
+#   License along with this library; if not, see
+#   <http://www.gnu.org/licenses/>.
+
+import os.path
+import shutil
+import tempfile
+import unittest
+
+from fogbugz.connection import MockConnection
+from fogbugz.plan import PlanConnection, replay
+
+class RecordingConnection(MockConnection):
+    """A mock connection that remembers the commands it was sent."""
+    def __init__(self):
+        self.posts = []
+        self._next = 100
+        MockConnection.__init__(self)
+
+    def _post(self, args, files=[]):
+        cmd = args['cmd']
+        if cmd not in ['logon', 'listPeople', 'listProjects']:
+            self.posts.append((cmd, dict(args), files))
+        if cmd in ['new', 'newPerson']:
+            self._next += 1
+        if cmd == 'new':
+            return '<response><case ixBug="%i" /></response>' % self._next
+        elif cmd == 'newPerson':
+            return '<response><person><ixPerson>%i</ixPerson></person></response>' % self._next
+        return MockConnection._post(self, args, files)
+
+class TestPlan(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, 'migration.plan')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_compile_and_replay(self):
+        plan = PlanConnection(self.filename)
+        person = plan.post('newPerson', {'sFullname':'Sally'}, element='person/ixPerson').text
+        ixbug = plan.post('new', {'sTitle':'A bug', 'ixPersonEditedBy':person},
+                [('notes.txt', 'some notes')], element='case').attrib['ixBug']
+        plan.post('edit', {'ixBug':ixbug, 'ixPersonEditedBy':person, 'sEvent':'More'}, [], 'case')
+        plan.post('new', {'sTitle':'Child', 'ixBugParent':ixbug}, element='case')
+        plan.close()
+
+        dest = RecordingConnection()
+        replay(self.filename, dest)
+        self.assertEqual(['newPerson', 'new', 'edit', 'new'], [cmd for cmd, args, files in dest.posts])
+        self.assertEqual('101', dest.posts[1][1]['ixPersonEditedBy'])
+        self.assertEqual([('notes.txt', 'some notes')], dest.posts[1][2])
+        self.assertEqual('102', dest.posts[2][1]['ixBug'])
+        self.assertEqual('More', dest.posts[2][1]['sEvent'])
+        self.assertEqual('102', dest.posts[3][1]['ixBugParent'])
+        self.assertEqual('A bug', dest.posts[1][1]['sTitle'])
+
+    def test_queries_use_lookup(self):
+        lookup = MockConnection(search='<response><cases count="0" /></response>')
+        plan = PlanConnection(self.filename, lookup)
+        self.assertEqual('0', plan.post('search', {'q':'1'}).find('cases').attrib['count'])
+        plan.close()
+
+        dest = RecordingConnection()
+        replay(self.filename, dest)
+        self.assertEqual([], dest.posts)
+
+
+    def test_ref_within_value(self):
+        plan = PlanConnection(self.filename)
+        first = plan.post('new', {'sTitle':'First'}, element='case').attrib['ixBug']
+        second = plan.post('new', {'sTitle':'Second'}, element='case').attrib['ixBug']
+        plan.post('edit', {'ixBug':first, 'ixBugDuplicates':'%s,%s' % (first, second)})
+        plan.close()
+
+        dest = RecordingConnection()
+        replay(self.filename, dest)
+        self.assertEqual('101,102', dest.posts[2][1]['ixBugDuplicates'])
+
+    def test_resume(self):
+        plan = PlanConnection(self.filename)
+        ixbug = plan.post('new', {'sTitle':'A bug'}, element='case').attrib['ixBug']
+        plan.post('edit', {'ixBug':ixbug, 'sEvent':'First'})
+        plan.post('edit', {'ixBug':ixbug, 'sEvent':'Second'})
+        plan.close()
+
+        class FailingConnection(RecordingConnection):
+            def _post(self, args, files=[]):
+                if args.get('sEvent') == 'Second':
+                    raise IOError('Connection reset')
+                return RecordingConnection._post(self, args, files)
+        log = os.path.join(self.dir, 'replay.log')
+        self.assertRaises(IOError, replay, self.filename, FailingConnection(), log)
+
+        dest = RecordingConnection()
+        self.assertEqual({'@plan:0':'101'}, replay(self.filename, dest, log))
+        self.assertEqual([('edit', '101', 'Second')], [(cmd, args['ixBug'],
+            args['sEvent']) for cmd, args, files in dest.posts])
+        # Everything has been applied now.
+        replay(self.filename, dest, log)
+        self.assertEqual(1, len(dest.posts))
+
+
+if __name__ == '__main__':
+    unittest.main()
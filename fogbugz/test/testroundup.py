@@ -0,0 +1,132 @@
+#   Copyright (C) 2010 Henry Ludemann <misc@hl.id.au>
+#
+#   This file is part of the fogbugz import/export library.
+#
+#   The fogbugz import/export library is free software; you can redistribute it
+#   and/or modify it under the terms of the GNU Lesser General Public
+#   License as published by the Free Software Foundation; either
+#   version 2.1 of the License, or (at your option) any later version.
+#
+#   The fogbugz import/export library is distributed in the hope that it will be
+#   useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+#   of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#   Lesser General Public License for more details.
+#
+#   You should have received a copy of the GNU Lesser General Public
+#   License along with this library; if not, see
+#   <http://www.gnu.org/licenses/>.
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import fogbugz.roundup
+from fogbugz.roundup import intern_value, load_journal, record_class
+
+def row(id, second, user, action, items):
+    return "'%s':(2010, 3, 1, 10, 0, %.1f, 0, 0, 0):'%s':'%s':%s\n" % (
+            id, second, user, action, items)
+
+class TestRecord(unittest.TestCase):
+    def setUp(self):
+        self.Issue = record_class('issue', ['id', 'title', 'keyword'])
+
+    def test_attributes(self):
+        issue = self.Issue('1', 'First', ('2',))
+        self.assertEqual('1', issue.id)
+        self.assertEqual('First', issue.title)
+        self.assertEqual(('2',), issue.keyword)
+        self.assertFalse(hasattr(issue, '__dict__'))
+        self.assertRaises(AttributeError, setattr, issue, 'other', 1)
+
+    def test_arity(self):
+        self.assertRaises(TypeError, self.Issue, '1', 'First')
+
+    def test_replace(self):
+        issue = self.Issue('1', 'First', ('2',))
+        changed = issue._replace(title='Changed')
+        self.assertEqual('First', issue.title)
+        self.assertEqual(self.Issue('1', 'Changed', ('2',)), changed)
+        self.assertNotEqual(issue, changed)
+        self.assertRaises(ValueError, issue._replace, other='x')
+
+    def test_class_is_shared(self):
+        self.assertTrue(self.Issue is record_class('issue', ['id', 'title', 'keyword']))
+        Other = record_class('issue', ['id', 'title'])
+        self.assertFalse(self.Issue is Other)
+        self.assertNotEqual(self.Issue('1', 'a', ()), Other('1', 'a'))
+
+class TestInternValue(unittest.TestCase):
+    def test_values(self):
+        self.assertEqual('1', intern_value('1'))
+        self.assertEqual('text', intern_value('text'))
+        self.assertEqual(None, intern_value(None))
+        self.assertEqual(('1', '2'), intern_value(['1', '2']))
+        self.assertEqual(['a'], intern_value(['a']))
+
+    def test_shared_fields(self):
+        a = intern_value(['1', '2'], 'keyword')
+        self.assertTrue(a is intern_value(['1', '2'], 'keyword'))
+        self.assertFalse(a is intern_value(['1', '2'], 'messages'))
+
+    def test_bounded(self):
+        limit = fogbugz.roundup._interned_limit
+        fogbugz.roundup._interned_limit = 3
+        try:
+            for i in range(10):
+                intern_value([str(i)], 'nosy')
+                self.assertTrue(len(fogbugz.roundup._interned) <= 3)
+        finally:
+            fogbugz.roundup._interned_limit = limit
+
+class TestJournal(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, 'issue-journals.csv')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, rows, mtime=1000):
+        open(self.filename, 'w').write(''.join(rows))
+        os.utime(self.filename, (mtime, mtime))
+
+    def test_out_of_order(self):
+        self.write([row(2, 0, 1, 'create', '{}'),
+            row(1, 0, 1, 'create', '{}'),
+            row(2, 10, 3, 'set', '''"{'status': '1'}"'''),
+            row(1, 20, 4, 'set', '''"{'title': 'New'}"''')])
+        journal = load_journal(self.dir, 'issue')
+        changes = journal['1']
+        self.assertEqual(['create', 'set'], [change.action for change in changes])
+        self.assertEqual({'title':'New'}, changes[1].items)
+        self.assertEqual('4', changes[1].user_id)
+        self.assertEqual(20.0, changes[1].timestamp[5])
+        self.assertEqual([{}, {'status':'1'}], [change.items for change in journal['2']])
+        self.assertRaises(KeyError, journal.__getitem__, '3')
+
+    def test_cached_index(self):
+        self.write([row(1, 0, 1, 'create', '{}')])
+        load_journal(self.dir, 'issue')
+        self.assertTrue(os.path.exists(os.path.join(self.dir, 'issue-journals.index')))
+        self.assertEqual(1, len(load_journal(self.dir, 'issue')['1']))
+
+    def test_rebuilt_when_size_changes(self):
+        self.write([row(1, 0, 1, 'create', '{}')])
+        load_journal(self.dir, 'issue')
+        self.write([row(1, 0, 1, 'create', '{}'), row(2, 0, 1, 'create', '{}')])
+        self.assertEqual(1, len(load_journal(self.dir, 'issue')['2']))
+
+    def test_rebuilt_when_mtime_changes(self):
+        # The same size, but the rows are in a different order.
+        self.write([row(1, 0, 1, 'create', '{}'), row(2, 0, 1, 'create', '{}')])
+        load_journal(self.dir, 'issue')
+        self.write([row(2, 0, 1, 'create', '{}'), row(1, 0, 1, 'create', '{}')],
+                mtime=2000)
+        journal = load_journal(self.dir, 'issue')
+        self.assertEqual(['1', '2'], [journal[id][0].id for id in ['1', '2']])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+#   Copyright (C) 2010 Henry Ludemann <misc@hl.id.au>
+#
+#   This file is part of the fogbugz import/export library.
+#
+#   The fogbugz import/export library is free software; you can redistribute it
+#   and/or modify it under the terms of the GNU Lesser General Public
+#   License as published by the Free Software Foundation; either
+#   version 2.1 of the License, or (at your option) any later version.
+#
+#   The fogbugz import/export library is distributed in the hope that it will be
+#   useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+#   of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#   Lesser General Public License for more details.
+#
+#   You should have received a copy of the GNU Lesser General Public
+#   License along with this library; if not, see
+#   <http://www.gnu.org/licenses/>.
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from fogbugz.snapshot import Snapshot
+
+class TestSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, 'export.snapshot')
+        self.source = os.path.join(self.dir, 'issue.csv')
+        self.write_source('id:title\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write_source(self, contents, mtime=1000):
+        open(self.source, 'w').write(contents)
+        os.utime(self.source, (mtime, mtime))
+
+    def test_reload(self):
+        stat = os.stat(self.source)
+        snapshot = Snapshot(self.filename)
+        self.assertEqual(None, snapshot.get('issue', stat))
+        data = (['id', 'title'], [['1', u'A title'], ['2', None]])
+        snapshot.put('issue', stat, data)
+        snapshot.put('user', stat, ['admin'])
+        snapshot.save()
+        snapshot.close()
+
+        snapshot = Snapshot(self.filename)
+        self.assertEqual(data, snapshot.get('issue', stat))
+        self.assertEqual(['admin'], snapshot.get('user', stat))
+        snapshot.close()
+
+    def test_replace_section(self):
+        stat = os.stat(self.source)
+        snapshot = Snapshot(self.filename)
+        snapshot.put('issue', stat, [1])
+        snapshot.put('user', stat, [2])
+        snapshot.save()
+        snapshot.put('issue', stat, [3, 4])
+        snapshot.save()
+        self.assertEqual([3, 4], Snapshot(self.filename).get('issue', stat))
+        self.assertEqual([2], Snapshot(self.filename).get('user', stat))
+
+    def test_saved_once(self):
+        stat = os.stat(self.source)
+        snapshot = Snapshot(self.filename)
+        snapshot.put('issue', stat, [1])
+        snapshot.put('user', stat, [2])
+        # The sections are only written when saving.
+        self.assertFalse(os.path.exists(self.filename))
+        self.assertEqual([1], snapshot.get('issue', stat))
+        snapshot.save()
+        os.utime(self.filename, (1000, 1000))
+        snapshot.save()
+        self.assertEqual(1000, os.stat(self.filename).st_mtime)
+        self.assertEqual([2], Snapshot(self.filename).get('user', stat))
+
+    def test_source_changed(self):
+        snapshot = Snapshot(self.filename)
+        snapshot.put('issue', os.stat(self.source), [1])
+        self.write_source('id:title\n', mtime=2000)
+        self.assertEqual(None, snapshot.get('issue', os.stat(self.source)))
+        self.write_source('id:title\n1:a\n')
+        self.assertEqual(None, snapshot.get('issue', os.stat(self.source)))
+
+    def test_invalid_snapshot(self):
+        open(self.filename, 'w').write('garbage')
+        snapshot = Snapshot(self.filename)
+        self.assertEqual(None, snapshot.get('issue', os.stat(self.source)))
+        snapshot.put('issue', os.stat(self.source), [1])
+        snapshot.save()
+        self.assertEqual([1], Snapshot(self.filename).get('issue', os.stat(self.source)))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+#   Copyright (C) 2010 Henry Ludemann <misc@hl.id.au>
+#
+#   This file is part of the fogbugz import/export library.
+#
+#   The fogbugz import/export library is free software; you can redistribute it
+#   and/or modify it under the terms of the GNU Lesser General Public
+#   License as published by the Free Software Foundation; either
+#   version 2.1 of the License, or (at your option) any later version.
+#
+#   The fogbugz import/export library is distributed in the hope that it will be
+#   useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+#   of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#   Lesser General Public License for more details.
+#
+#   You should have received a copy of the GNU Lesser General Public
+#   License along with this library; if not, see
+#   <http://www.gnu.org/licenses/>.
+
+
+import unittest
+
+from fogbugz.connection import MockConnection
+from fogbugz.upload import fogbugz_issue_upload, fogbugz_parallel_upload
+
+class Users:
+    def get_ixperson(self, id):
+        return 'person %s' % id
+
+projects = {'1':'project 1'}
+
+class UploadConnection(MockConnection):
+    """Records the posts over all of the connections."""
+    def __init__(self, posts, fail=None):
+        MockConnection.__init__(self)
+        self.posts = posts
+        self.fail = fail
+
+    def _post(self, args, files=[]):
+        if args['cmd'] != 'logon':
+            if args.get('sEvent') == self.fail:
+                raise IOError('Connection reset')
+            self.posts.append((self, args['ixBug'], args['sEvent']))
+        return MockConnection._post(self, args, files)
+
+def history(id, count):
+    for i in range(count):
+        yield 'edit', {'sEvent':'%s.%i' % (id, i), 'ixProject':'1',
+                'ixPersonEditedBy':'2'}, []
+
+class TestParallelUpload(unittest.TestCase):
+    def test_issue_upload(self):
+        posts = []
+        connection = UploadConnection(posts)
+        self.assertEqual('7', fogbugz_issue_upload(history('1', 2), Users(),
+            projects, connection, '7'))
+        self.assertEqual([(connection, '7', '1.0'), (connection, '7', '1.1')], posts)
+
+    def test_order(self):
+        posts = []
+        connections = [UploadConnection(posts) for i in range(3)]
+        histories = [(str(id), history(str(id), 5)) for id in range(10)]
+        ixbugs = dict((str(id), str(id + 100)) for id in range(10))
+        fogbugz_parallel_upload(histories, ixbugs, Users(), projects, connections)
+        self.assertEqual(50, len(posts))
+        for id in range(10):
+            issue = [(connection, event) for connection, ixbug, event in posts
+                    if ixbug == str(id + 100)]
+            # Each issue is uploaded in order, over a single connection.
+            self.assertEqual(['%i.%i' % (id, i) for i in range(5)],
+                    [event for connection, event in issue])
+            self.assertEqual(1, len(set(connection for connection, event in issue)))
+
+    def test_error(self):
+        posts = []
+        connections = [UploadConnection(posts, fail='3.1') for i in range(2)]
+        histories = [(str(id), history(str(id), 2)) for id in range(10)]
+        ixbugs = dict((str(id), str(id + 100)) for id in range(10))
+        self.assertRaises(SystemExit, fogbugz_parallel_upload, histories,
+                ixbugs, Users(), projects, connections)
+        self.assertFalse(('103', '3.1') in [(ixbug, event) for c, ixbug, event in posts])
+
+if __name__ == '__main__':
+    unittest.main()
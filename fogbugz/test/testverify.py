@@ -0,0 +1,84 @@
+#   Copyright (C) 2010 Henry Ludemann <misc@hl.id.au>
+#
+#   This file is part of the fogbugz import/export library.
+#
+#   The fogbugz import/export library is free software; you can redistribute it
+#   and/or modify it under the terms of the GNU Lesser General Public
+#   License as published by the Free Software Foundation; either
+#   version 2.1 of the License, or (at your option) any later version.
+#
+#   The fogbugz import/export library is distributed in the hope that it will be
+#   useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+#   of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#   Lesser General Public License for more details.
+#
+#   You should have received a copy of the GNU Lesser General Public
+#   License along with this library; if not, see
+#   <http://www.gnu.org/licenses/>.
+
+import os
+import tempfile
+import unittest
+
+from fogbugz.connection import MockConnection
+from fogbugz.verify import differences, make_digest, verify, read_id_map, write_id_map
+
+_case = '''<case ixBug="%s"><ixBug>%s</ixBug><sTitle>%s</sTitle>
+<sStatus>Closed (Fixed)</sStatus><sProject>Inbox</sProject>
+<sPersonAssignedTo>CLOSED</sPersonAssignedTo><tags><tag>b</tag><tag>a</tag></tags>
+<events><event><s>First message</s><rgAttachments><attachment>
+<sFileName>log.txt</sFileName></attachment></rgAttachments></event>
+<event><s>First message</s><rgAttachments /></event>
+<event><s></s><rgAttachments /></event></events></case>'''
+
+class DestConnection(MockConnection):
+    def __init__(self, titles):
+        MockConnection.__init__(self)
+        self.titles = titles
+
+    def _post(self, args, files=[]):
+        if args['cmd'] == 'search':
+            return '<response><cases>%s</cases></response>' % ''.join(
+                    _case % (ixbug, ixbug, self.titles[ixbug])
+                    for ixbug in args['q'].split(','))
+        return MockConnection._post(self, args, files)
+
+def _digest(title):
+    return make_digest(title, 'Closed', 'Inbox', ['a', 'b'], 'Sally',
+            ['First message\r\n'], ['log.txt'])
+
+class TestVerify(unittest.TestCase):
+    def test_make_digest(self):
+        self.assertEqual(_digest('Title'), make_digest('Title', 'Closed (Fixed)',
+            'Inbox', ['b', 'a'], 'CLOSED', ['First message', 'First message', ''],
+            ['log.txt']))
+        self.assertEqual([('title', 'Title', 'Other')],
+                differences(_digest('Title'), _digest('Other')))
+        self.assertEqual([('case', 'present', 'missing')],
+                differences(_digest('Title'), None))
+
+    def test_verify(self):
+        handle, report = tempfile.mkstemp()
+        os.close(handle)
+        try:
+            dest = [DestConnection({'11':'One', '12':'Changed', '13':'Three'})
+                    for i in range(2)]
+            source = [('1', _digest('One')), ('2', _digest('Two')), ('3', _digest('Three'))]
+            self.assertEqual((3, 1), verify(source, dest,
+                {'1':'11', '2':'12', '3':'13'}, report, page_size=2))
+            self.assertEqual("Case 2 (destination 12): title 'Two' != 'Changed'\n"
+                    "Verified 3 cases; 1 differ.\n", open(report).read())
+
+            def failing():
+                yield '1', _digest('One')
+                raise IOError('Failed')
+            self.assertRaises(IOError, verify, failing(), dest, {'1':'11'}, report)
+
+            write_id_map(report, {'10':'3', '9':'@plan:2'})
+            self.assertEqual({'10':'3', '9':'@plan:2'}, read_id_map(report))
+        finally:
+            os.remove(report)
+
+
+if __name__ == '__main__':
+    unittest.main()
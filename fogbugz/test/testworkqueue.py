@@ -0,0 +1,229 @@
+#   Copyright (C) 2010 Henry Ludemann <misc@hl.id.au>
+#
+#   This file is part of the fogbugz import/export library.
+#
+#   The fogbugz import/export library is free software; you can redistribute it
+#   and/or modify it under the terms of the GNU Lesser General Public
+#   License as published by the Free Software Foundation; either
+#   version 2.1 of the License, or (at your option) any later version.
+#
+#   The fogbugz import/export library is distributed in the hope that it will be
+#   useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+#   of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#   Lesser General Public License for more details.
+#
+#   You should have received a copy of the GNU Lesser General Public
+#   License along with this library; if not, see
+#   <http://www.gnu.org/licenses/>.
+
+
+import os.path
+import shutil
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+from fogbugz.connection import MockConnection
+from fogbugz.export import Change
+from fogbugz.workqueue import WorkQueue, WorkQueueError, LeaseLost, \
+        dependency_shards, migrate_shards
+
+def issue(ixbug, *parents):
+    """Create an issue whose changes have the given parents (latest first)."""
+    return [Change([('ixBug', ixbug), ('ixBugParent', parent)]) for parent in
+            parents or ['0']]
+
+def change(cmd, ixbug):
+    return Change([('ixBug', ixbug), ('ixBugParent', '0'), ('sEvent', cmd),
+        ('sTitle', 'Bug %s' % ixbug), ('dt', '2010-01-0%sT00:00:00Z' % ixbug)])
+
+def get_changes(issues, start, loading):
+    changes = [(params['sEvent'], params, []) for issue in issues for params in issue]
+    return iter(changes[start:])
+
+class SearchConnection(MockConnection):
+    """A destination whose searches return the given cases."""
+    def __init__(self, cases):
+        MockConnection.__init__(self)
+        self.cases = cases
+        self.searches = 0
+
+    def _post(self, args, files=[]):
+        if args['cmd'] == 'search':
+            self.searches += 1
+            return '<response><cases>%s</cases></response>' % ''.join(
+                '<case><ixBug>%s</ixBug><sTitle>%s</sTitle><dtOpened>%s</dtOpened></case>'
+                % case for case in self.cases)
+        return MockConnection._post(self, args, files)
+
+class FakeDestination:
+    def __init__(self, cases=[], fail=None):
+        self.dest = SearchConnection(cases)
+        self.fail = fail
+        self.sent = []
+        self.ixBugLookup = {}
+
+    def send(self, change):
+        cmd, params, files = change
+        if (cmd, params['ixBug']) == self.fail:
+            sys.exit('Failed to send %s' % params['ixBug'])
+        self.sent.append((cmd, params['ixBug']))
+        if cmd == 'new':
+            self.ixBugLookup[params['ixBug']] = str(100 + int(params['ixBug']))
+
+class TestDependencyShards(unittest.TestCase):
+    def test_parents_kept_together(self):
+        issues = [issue('1'), issue('2'), issue('3', '0', '1'), issue('4'),
+                issue('5', '2', '4'), issue('6')]
+        shards = dependency_shards(issues, 3)
+        ixbugs = sorted([i[0]['ixBug'] for i in shard] for shard in shards)
+        self.assertEqual([['1', '3'], ['2', '4', '5'], ['6']], ixbugs)
+
+    def test_balanced(self):
+        issues = [issue(str(i)) for i in range(10)]
+        shards = dependency_shards(issues, 4)
+        self.assertEqual(4, len(shards))
+        self.assertEqual([2, 2, 3, 3], sorted(len(shard) for shard in shards))
+        # The issues keep their order within a shard.
+        for shard in shards:
+            self.assertEqual(sorted(shard, key=lambda i:int(i[0]['ixBug'])), shard)
+
+    def test_fewer_groups_than_shards(self):
+        shards = dependency_shards([issue('1'), issue('2', '1')], 4)
+        self.assertEqual(1, len(shards))
+
+class TestWorkQueue(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, 'queue')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_claim_and_finish(self):
+        queue = WorkQueue(self.filename)
+        self.assertTrue(queue.is_empty())
+        queue.add_shards([[issue('1')], [issue('2'), issue('3')]])
+        first = queue.claim('a')
+        second = WorkQueue(self.filename).claim('b')
+        self.assertEqual([issue('1')], first.issues)
+        self.assertEqual([issue('2'), issue('3')], second.issues)
+        self.assertEqual(None, queue.claim('c'))
+
+        queue.progress(first, 'a', 1, ('1', '10'))
+        queue.finish(first, 'a')
+        self.assertEqual({'done':1, 'claimed':1}, queue.status())
+        self.assertEqual({'1':'10'}, queue.id_map())
+
+    def test_resume_after_lease(self):
+        queue = WorkQueue(self.filename, lease=-1)
+        queue.add_shards([[issue('1'), issue('2')]])
+        shard = queue.claim('a')
+        queue.progress(shard, 'a', 3, ('1', '10'))
+
+        # The lease has expired, so another worker can take it over.
+        resumed = queue.claim('b')
+        self.assertEqual(3, resumed.sent)
+        self.assertEqual({'1':'10'}, resumed.ids)
+        self.assertRaises(LeaseLost, queue.progress, shard, 'a', 4)
+        queue.finish(resumed, 'b')
+        self.assertEqual({'done':1}, queue.status())
+
+    def test_resume_while_sending(self):
+        queue = WorkQueue(self.filename, lease=-1)
+        queue.add_shards([[issue('1'), issue('2')]])
+        shard = queue.claim('a')
+        self.assertEqual(None, shard.sending)
+        queue.sending(shard, 'a', 0)
+        queue.progress(shard, 'a', 1, ('1', '10'))
+        queue.sending(shard, 'a', 1)
+
+        # The change being sent when the lease expired may have been sent.
+        resumed = queue.claim('b')
+        self.assertEqual((1, 1), (resumed.sent, resumed.sending))
+        self.assertRaises(LeaseLost, queue.sending, shard, 'a')
+        queue.progress(resumed, 'b', 2)
+        queue.finish(resumed, 'b')
+        self.assertEqual({'done':1}, queue.status())
+
+    def crashed_while_sending(self, index):
+        """Make a queue whose worker stopped while sending change 'index'."""
+        queue = WorkQueue(self.filename, lease=-1)
+        queue.add_shards([[[change('new', '1'), change('edit', '1')],
+            [change('new', '2')]]])
+        shard = queue.claim('a')
+        for i in range(index):
+            queue.sending(shard, 'a', i)
+            queue.progress(shard, 'a', i + 1, ('1', '101') if i == 0 else None)
+        queue.sending(shard, 'a', index)
+        return queue
+
+    def test_resume_created(self):
+        queue = self.crashed_while_sending(2)
+        # An unrelated case (already in the map) has the same title & date.
+        destination = FakeDestination([('101', 'Bug 2', '2010-01-02T00:00:00Z'),
+            ('102', 'Bug 2', '2010-01-02T00:00:00Z')])
+        migrate_shards(queue, destination, get_changes, 'b')
+        self.assertEqual([], destination.sent)
+        self.assertEqual({'1':'101', '2':'102'}, queue.id_map())
+        self.assertEqual({'done':1}, queue.status())
+
+    def test_resume_not_created(self):
+        queue = self.crashed_while_sending(2)
+        destination = FakeDestination([('101', 'Bug 1', '2010-01-01T00:00:00Z')])
+        migrate_shards(queue, destination, get_changes, 'b')
+        self.assertEqual([('new', '2')], destination.sent)
+        self.assertEqual({'1':'101', '2':'102'}, queue.id_map())
+
+    def test_resume_edit(self):
+        queue = self.crashed_while_sending(1)
+        destination = FakeDestination()
+        migrate_shards(queue, destination, get_changes, 'b')
+        # Only a 'new' is looked for; other changes are sent again.
+        self.assertEqual(0, destination.dest.searches)
+        self.assertEqual([('edit', '1'), ('new', '2')], destination.sent)
+
+    def test_server_error(self):
+        queue = WorkQueue(self.filename)
+        queue.add_shards([[[change('new', '1')]], [[change('new', '2')]]])
+        destination = FakeDestination(fail=('new', '1'))
+        migrate_shards(queue, destination, get_changes, 'a')
+        # The failure is recorded, and the worker carries on with the next shard.
+        self.assertEqual([(1, 'a', 'Failed to send 1')], queue.errors())
+        self.assertEqual({'done':1, 'failed':1}, queue.status())
+        self.assertEqual([('new', '2')], destination.sent)
+
+    def test_plain_changes(self):
+        queue = WorkQueue(self.filename)
+        queue.add_shards([[issue('1', '0')]])
+        changes = queue.claim('a').issues[0]
+        self.assertEqual([{'ixBug':'1', 'ixBugParent':'0'}], changes)
+        self.assertEqual(dict, type(changes[0]))
+
+    def test_other_format(self):
+        db = sqlite3.connect(self.filename)
+        db.executescript("create table shards (id integer primary key, issues blob);"
+                "insert into shards (issues) values ('');")
+        db.commit()
+        db.close()
+        self.assertRaises(WorkQueueError, WorkQueue, self.filename)
+
+    def test_retry_failed(self):
+        queue = WorkQueue(self.filename)
+        queue.add_shards([[issue('1')]])
+        shard = queue.claim('a')
+        queue.fail(shard, 'a', 'Bad request')
+        self.assertEqual([(1, 'a', 'Bad request')], queue.errors())
+        self.assertEqual(None, queue.claim('b'))
+        self.assertEqual(1, queue.retry_failed())
+        self.assertEqual(1, queue.claim('b').id)
+
+    def test_identities(self):
+        queue = WorkQueue(self.filename)
+        queue.add_identity('ixPerson', '3', '10')
+        queue.add_identity('sProject', 'Inbox', '2')
+        self.assertEqual({'3':'10'}, WorkQueue(self.filename).identities('ixPerson'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+#   Copyright (C) 2010 Henry Ludemann <misc@hl.id.au>
+#
+#   This file is part of the fogbugz import/export library.
+#
+#   The fogbugz import/export library is free software; you can redistribute it
+#   and/or modify it under the terms of the GNU Lesser General Public
+#   License as published by the Free Software Foundation; either
+#   version 2.1 of the License, or (at your option) any later version.
+#
+#   The fogbugz import/export library is distributed in the hope that it will be
+#   useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+#   of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#   Lesser General Public License for more details.
+#
+#   You should have received a copy of the GNU Lesser General Public
+#   License along with this library; if not, see
+#   <http://www.gnu.org/licenses/>.
+
+"""Upload the changes to roundup issues to fogbugz.
+
+The changes are the (cmd, params, files) commands of an issue, with the
+params still referring to the roundup users and project keywords.
+"""
+
+import logging
+import Queue
+import sys
+import threading
+
+def fogbugz_issue_upload(commands, users, project_lookup, connection, ixbug=None):
+    """Upload issue changes to fogbugz.
+
+    commands -- The changes from fogbugz_issue_commands.
+    ixbug -- The fogbugz id of the issue, if it has already been created.
+    return -- The fogbugz id of the issue."""
+    for cmd, params, files in commands:
+        params = dict(params)
+        if 'ixProject' in params:
+            params['ixProject'] = project_lookup[params['ixProject']]
+        for name in ['ixPersonAssignedTo', 'ixPersonEditedBy']:
+            if name in params:
+                params[name] = users.get_ixperson(params[name])
+        if ixbug is not None:
+            params['ixBug'] = ixbug
+        response = connection.post(cmd, params, files, 'case')
+        if ixbug is None:
+            ixbug = response.attrib['ixBug']
+    return ixbug
+
+def fogbugz_parallel_upload(histories, ixbugs, users, project_lookup, connections):
+    """Upload the rest of the history of issues that have already been created.
+
+    The changes to an issue are sent in order over one connection, but
+    different issues are uploaded concurrently over the given connections.
+
+    histories -- A list of (roundup id, commands) for each issue, where the
+        commands are the rest of its fogbugz_issue_commands (after the 'new').
+    ixbugs -- A dictionary of roundup id to the fogbugz id of the issue.
+    """
+    queue = Queue.Queue()
+    for history in histories:
+        queue.put(history)
+    errors = []
+
+    def upload(connection):
+        while not errors:
+            try:
+                id, commands = queue.get_nowait()
+            except Queue.Empty:
+                break
+            try:
+                logging.info('uploading the history of issue %s...', id)
+                fogbugz_issue_upload(commands, users, project_lookup,
+                        connection, ixbugs[id])
+            except BaseException, ex:
+                errors.append((id, ex))
+
+    threads = [threading.Thread(target=upload, args=(connection,))
+            for connection in connections]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        sys.exit('Failed to upload issues:\n%s' % '\n'.join(
+            '%s: %s' % (id, ex) for id, ex in errors))
@@ -0,0 +1,178 @@
+#   Copyright (C) 2010 Henry Ludemann <misc@hl.id.au>
+#
+#   This file is part of the fogbugz import/export library.
+#
+#   The fogbugz import/export library is free software; you can redistribute it
+#   and/or modify it under the terms of the GNU Lesser General Public
+#   License as published by the Free Software Foundation; either
+#   version 2.1 of the License, or (at your option) any later version.
+#
+#   The fogbugz import/export library is distributed in the hope that it will be
+#   useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+#   of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#   Lesser General Public License for more details.
+#
+#   You should have received a copy of the GNU Lesser General Public
+#   License along with this library; if not, see
+#   <http://www.gnu.org/licenses/>.
+
+"""Verify a migration by comparing digests of the source and destination cases.
+
+The destination cases are loaded with paged searches for lists of case
+numbers (over several connections at once), so verifying never needs a
+request per case.
+"""
+
+from collections import namedtuple
+import hashlib
+import logging
+import threading
+
+from fogbugz.export import ExportError, ShardFetcher
+
+# The messages are compared rather than the number of events. Edits that
+# change nothing, and (when coalescing) merged changes, don't become events in
+# the destination, so the event counts would differ.
+Digest = namedtuple('Digest', 'title status project tags assignee distinct_messages attachments')
+
+digest_columns = ['ixBug', 'sTitle', 'sStatus', 'sProject', 'sPersonAssignedTo', 'tags', 'events']
+
+def _text(value):
+    if isinstance(value, str):
+        return value.decode('utf8', 'replace')
+    return value
+
+def make_digest(title, status, project, tags, assignee, messages, attachments):
+    """Create the Digest of a case, normalised to what fogbugz stores.
+
+    status -- The fogbugz status; only the first word (eg: 'Resolved') is kept.
+    messages -- The text of the case's messages. Only the distinct messages are
+        compared, as the history may repeat a message over several events.
+    attachments -- The attachment filenames.
+    """
+    status = status.split()[0]
+    if status == 'Closed':
+        # Fogbugz assigns closed cases to its 'CLOSED' user.
+        assignee = None
+    messages = sorted(set(u'\n'.join(line.rstrip() for line in _text(m).strip().splitlines())
+            for m in messages if m and m.strip()))
+    checksum = hashlib.sha1(u'\0'.join(messages).encode('utf8')).hexdigest()
+    return Digest(_text(title), status, _text(project),
+            tuple(sorted(_text(tag) for tag in tags)), _text(assignee),
+            (len(messages), checksum[:12]),
+            tuple(sorted(_text(name) for name in attachments)))
+
+def case_digest(case, users={}, projects={}):
+    """Get the Digest of a case element from a search for digest_columns.
+
+    users -- Maps the names of people to the names used in the digest.
+    projects -- Maps the names of projects to the names used in the digest.
+    """
+    missing = [c for c in digest_columns if case.find(c) is None]
+    if missing:
+        # Archives made before verifying was supported lack the columns.
+        raise ExportError('Case %s has no %s to verify! If it is from an archive, '
+                'export the archive again.' % (case.findtext('ixBug'), ', '.join(missing)))
+    assignee = case.find('sPersonAssignedTo').text
+    project = case.find('sProject').text
+    return make_digest(case.find('sTitle').text, case.find('sStatus').text,
+            projects.get(project, project),
+            [tag.text for tag in case.findall('tags/tag')],
+            users.get(assignee, assignee),
+            [event.find('s').text for event in case.findall('events/event')
+                if event.find('s') is not None],
+            [attachment.find('sFileName').text for attachment in
+                case.findall('events/event/rgAttachments/attachment')])
+
+def _digest_params(search):
+    return {'q':search, 'cols':','.join(digest_columns)}
+
+def fetch_digests(connections, ixbugs, page_size=500, users={}, projects={}):
+    """Start loading the digests of cases, returning an iterator over them.
+
+    The cases are loaded in pages over the connections concurrently (starting
+    immediately); the iterator yields the (ixBug, Digest) of each case.
+    """
+    ixbugs = sorted(int(ixbug) for ixbug in ixbugs)
+    pages = [ixbugs[i:i + page_size] for i in range(0, len(ixbugs), page_size)]
+    fetcher = ShardFetcher(connections, pages, 3, _digest_params)
+    return _digests(fetcher, len(pages), users, projects)
+
+def _digests(fetcher, count, users, projects):
+    for i in range(count):
+        for case in fetcher.get(i):
+            yield case.find('ixBug').text, case_digest(case, users, projects)
+
+def _format(value):
+    if isinstance(value, basestring):
+        return u"'%s'" % value
+    elif isinstance(value, tuple) and value and isinstance(value[0], int):
+        return u'%i distinct (%s)' % value
+    elif isinstance(value, tuple):
+        return u'[%s]' % u', '.join(value)
+    return unicode(value)
+
+def differences(source, dest):
+    """Get the (field, source value, dest value) differences between digests.
+
+    dest -- The destination Digest, or None if the case is missing.
+    """
+    if dest is None:
+        return [('case', 'present', 'missing')]
+    return [(field, source_value, dest_value) for field, source_value, dest_value
+            in zip(Digest._fields, source, dest) if source_value != dest_value]
+
+def _collect(digests, result, errors):
+    try:
+        result.update(digests)
+    except (Exception, SystemExit), ex:
+        errors.append(ex)
+
+def verify(source_digests, dest_connections, id_map, report, page_size=500):
+    """Compare the source digests with the destination, writing a report.
+
+    source_digests -- An iterable of (ixBug, Digest) for the migrated cases.
+    dest_connections -- The connections to load the destination cases over.
+    id_map -- A dictionary mapping the source ixBugs to destination ixBugs.
+    report -- The filename to write the differences to.
+    return -- The (number of cases, number of cases that differ).
+    """
+    logging.info('Loading %i cases from the destination...', len(id_map))
+    # The source digests are built in another thread, while the destination
+    # digests are built from each page as it arrives.
+    dest_digests = fetch_digests(dest_connections, id_map.values(), page_size)
+    digests, errors = {}, []
+    thread = threading.Thread(target=_collect, args=(source_digests, digests, errors))
+    thread.daemon = True
+    thread.start()
+    dest_digests = dict(dest_digests)
+    while thread.isAlive():
+        # Join with a timeout, so we can still be interrupted.
+        thread.join(1)
+    if errors:
+        raise errors[0]
+    source_digests = digests
+    cases = different = 0
+    output = open(report, 'w')
+    for ixbug in sorted(source_digests, key=int):
+        dest_ixbug = id_map.get(ixbug)
+        changes = differences(source_digests[ixbug], dest_digests.get(dest_ixbug))
+        for field, source, dest in changes:
+            output.write((u'Case %s (destination %s): %s %s != %s\n' % (ixbug,
+                dest_ixbug, field, _format(source), _format(dest))).encode('utf8'))
+        cases += 1
+        different += 1 if changes else 0
+    output.write('Verified %i cases; %i differ.\n' % (cases, different))
+    output.close()
+    logging.info('Verified %i cases; %i differ (see %s).', cases, different, report)
+    return cases, different
+
+def read_id_map(filename):
+    """Read a map of source ixBugs to destination ixBugs."""
+    return dict(line.split() for line in open(filename, 'r') if line.strip())
+
+def write_id_map(filename, ids):
+    output = open(filename, 'w')
+    for source, dest in sorted(ids.items(), key=lambda item:int(item[0])):
+        output.write('%s %s\n' % (source, dest))
+    output.close()
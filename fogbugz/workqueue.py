@@ -0,0 +1,333 @@
+#   Copyright (C) 2010 Henry Ludemann <misc@hl.id.au>
+#
+#   This file is part of the fogbugz import/export library.
+#
+#   The fogbugz import/export library is free software; you can redistribute it
+#   and/or modify it under the terms of the GNU Lesser General Public
+#   License as published by the Free Software Foundation; either
+#   version 2.1 of the License, or (at your option) any later version.
+#
+#   The fogbugz import/export library is distributed in the hope that it will be
+#   useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+#   of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#   Lesser General Public License for more details.
+#
+#   You should have received a copy of the GNU Lesser General Public
+#   License along with this library; if not, see
+#   <http://www.gnu.org/licenses/>.
+
+"""A local work queue for migrating shards of cases in several processes.
+
+The cases are split into shards that are closed over their parents (a case
+and every case it has been a subcase of are in the same shard), so each shard
+can be migrated on its own. The shards are stored (with their histories) in a
+sqlite database; workers claim a shard for a lease, record each change before
+and after sending it (so a shard resumes where it stopped if a worker dies),
+and record the cases they create.
+"""
+
+import cPickle
+import logging
+import os
+import socket
+import sqlite3
+import time
+
+# The version of the schema (and of the stored shards); a queue made with
+# another version can't be resumed.
+_format = 2
+
+_schema = '''
+create table if not exists shards (
+    id integer primary key,
+    issues blob not null,
+    cases integer not null,
+    changes integer not null,
+    state text not null default 'pending',
+    worker text,
+    lease real,
+    sent integer not null default 0,
+    sending integer,
+    error text);
+create table if not exists cases (
+    source text primary key,
+    dest text not null,
+    shard integer not null);
+create table if not exists identities (
+    kind text not null,
+    source text not null,
+    dest text not null,
+    primary key (kind, source));
+'''
+
+class WorkQueueError (Exception):
+    pass
+
+class LeaseLost (Exception):
+    """Another worker has taken over a shard (as our lease expired)."""
+    pass
+
+def _find(parents, ixbug):
+    root = ixbug
+    while parents.setdefault(root, root) != root:
+        root = parents[root]
+    while parents[ixbug] != root:
+        parents[ixbug], ixbug = root, parents[ixbug]
+    return root
+
+def dependency_shards(issues, count):
+    """Split the issues into at most 'count' shards closed over their parents.
+
+    issues -- The list of changes of each issue (as from get_issues).
+    return -- A list of shards, each a list of issues (in their original
+        order). The shards have similar numbers of changes where possible.
+    """
+    issues = list(issues)
+    parents = {}
+    for issue in issues:
+        for change in issue:
+            parent = change.get('ixBugParent')
+            if parent not in (None, '0'):
+                parents[_find(parents, parent)] = _find(parents, change['ixBug'])
+    groups = {}
+    for i, issue in enumerate(issues):
+        groups.setdefault(_find(parents, issue[0]['ixBug']), []).append(i)
+
+    # Put the largest groups first, each into the smallest shard so far.
+    shards = [[0, []] for i in range(min(count, len(groups)))]
+    for group in sorted(groups.values(), key=lambda group:
+            -sum(len(issues[i]) for i in group)):
+        shard = min(shards, key=lambda shard:shard[0])
+        shard[0] += sum(len(issues[i]) for i in group)
+        shard[1].extend(group)
+    return [[issues[i] for i in sorted(indices)] for size, indices in shards]
+
+class Shard:
+    """A claimed shard of issues.
+
+    issues -- The issues, each a list of changes (as dictionaries).
+    sent -- The number of changes already sent (by an earlier worker).
+    sending -- The index of the change an earlier worker was sending when it
+        stopped (it may or may not have been sent), or None.
+    ids -- The source to destination ixBugs of the cases already created.
+    """
+    def __init__(self, id, issues, sent, sending, ids):
+        self.id = id
+        self.issues = issues
+        self.sent = sent
+        self.sending = sending
+        self.ids = ids
+
+def worker_name():
+    return '%s:%i' % (socket.gethostname(), os.getpid())
+
+class WorkQueue:
+    def __init__(self, filename, lease=300):
+        """Open (or create) a work queue.
+
+        lease -- The number of seconds a worker holds a shard for without
+            recording progress, before another worker may take it over.
+        """
+        self._lease = lease
+        # Transactions are started explicitly, so claims are atomic between
+        # processes.
+        self._db = sqlite3.connect(filename, timeout=60, isolation_level=None)
+        self._db.text_factory = str
+        self._db.executescript(_schema)
+        if self._db.execute('pragma user_version').fetchone()[0] != _format:
+            if not self.is_empty():
+                raise WorkQueueError("The work queue %s was made by another version; "
+                        "remove it to start again." % filename)
+            self._db.executescript('drop table shards; drop table cases; '
+                    'drop table identities;' + _schema)
+            self._db.execute('pragma user_version = %i' % _format)
+
+    def _transaction(self, function, *args):
+        self._db.execute('begin immediate')
+        try:
+            result = function(*args)
+        except:
+            self._db.execute('rollback')
+            raise
+        self._db.execute('commit')
+        return result
+
+    def is_empty(self):
+        return self._db.execute('select count(*) from shards').fetchone()[0] == 0
+
+    def add_shards(self, shards):
+        """Add shards (each a list of issues) to be migrated.
+
+        The changes are stored as plain dictionaries, so the queue doesn't
+        depend on how the export represents them.
+        """
+        def add():
+            for issues in shards:
+                issues = [[dict(change.items()) for change in issue] for issue in issues]
+                self._db.execute('insert into shards (issues, cases, changes) '
+                        'values (?, ?, ?)', (sqlite3.Binary(cPickle.dumps(issues,
+                            cPickle.HIGHEST_PROTOCOL)), len(issues),
+                            sum(len(issue) for issue in issues)))
+        self._transaction(add)
+        logging.info('Added %i shards to the work queue.', len(shards))
+
+    def add_identity(self, kind, source, dest):
+        self._db.execute('insert or replace into identities values (?, ?, ?)',
+                (kind, source, dest))
+
+    def identities(self, kind):
+        """Get the source to destination map of a kind of identity."""
+        return dict(self._db.execute('select source, dest from identities '
+            'where kind = ?', (kind,)))
+
+    def claim(self, worker):
+        """Claim a pending shard (or one whose lease has expired).
+
+        return -- A Shard, or None if there is nothing left to claim.
+        """
+        def claim():
+            now = time.time()
+            row = self._db.execute("select id, issues, sent, sending from shards where "
+                    "state = 'pending' or (state = 'claimed' and lease < ?) "
+                    "order by id limit 1", (now,)).fetchone()
+            if row is None:
+                return None
+            id, issues, sent, sending = row
+            self._db.execute("update shards set state = 'claimed', worker = ?, "
+                    "lease = ? where id = ?", (worker, now + self._lease, id))
+            ids = dict(self._db.execute('select source, dest from cases where '
+                'shard = ?', (id,)))
+            return Shard(id, cPickle.loads(str(issues)), sent, sending, ids)
+        return self._transaction(claim)
+
+    def _update(self, shard, worker, sql, args=()):
+        cursor = self._db.execute('update shards set %s where id = ? and '
+                "worker = ? and state = 'claimed'" % sql, args + (shard.id, worker))
+        if cursor.rowcount != 1:
+            raise LeaseLost('Shard %i has been taken over by another worker!' % shard.id)
+
+    def sending(self, shard, worker, index=None):
+        """Extend the lease, recording the change about to be sent (if any).
+
+        index -- The index of the change in the shard.
+        """
+        if index is None:
+            sql, args = 'lease = ?', (time.time() + self._lease,)
+        else:
+            sql, args = 'lease = ?, sending = ?', (time.time() + self._lease, index)
+        self._transaction(self._update, shard, worker, sql, args)
+
+    def progress(self, shard, worker, sent, case=None):
+        """Record the number of changes sent, and extend the lease.
+
+        case -- The (source, destination) ixBugs of a case that was created.
+        """
+        def progress():
+            self._update(shard, worker, 'sent = ?, sending = null, lease = ?',
+                    (sent, time.time() + self._lease))
+            if case is not None:
+                self._db.execute('insert or replace into cases values (?, ?, ?)',
+                        case + (shard.id,))
+        self._transaction(progress)
+
+    def finish(self, shard, worker):
+        self._transaction(self._update, shard, worker, "state = 'done'")
+
+    def fail(self, shard, worker, error):
+        self._transaction(self._update, shard, worker, "state = 'failed', error = ?",
+                (error,))
+
+    def retry_failed(self):
+        """Make the failed shards pending again (they resume where they stopped)."""
+        return self._db.execute("update shards set state = 'pending', error = null "
+                "where state = 'failed'").rowcount
+
+    def status(self):
+        """Get the number of shards in each state."""
+        return dict(self._db.execute('select state, count(*) from shards group by state'))
+
+    def errors(self):
+        """Get the (shard, worker, error) of each failed shard."""
+        return list(self._db.execute("select id, worker, error from shards where "
+            "state = 'failed' order by id"))
+
+    def id_map(self):
+        """Get the source to destination ixBugs of the created cases."""
+        return dict(self._db.execute('select source, dest from cases'))
+
+    def close(self):
+        self._db.close()
+
+def find_created(dest, params, known):
+    """Find the case a 'new' change may have created, or None.
+
+    The case has the change's title and opened date, and isn't one of the
+    known cases (the destination ixBugs of the cases already created).
+    """
+    found = [case.find('ixBug').text for case in dest.post('search', {
+        'q':'title:"%s"' % params['sTitle'].replace('"', ' '),
+        'cols':'ixBug,sTitle,dtOpened'}).findall('cases/case')
+        if case.findtext('sTitle') == params['sTitle'] and
+            case.findtext('dtOpened') == params['dt'] and
+            case.find('ixBug').text not in known]
+    if len(found) > 1:
+        raise WorkQueueError('Bug %s may have been created as any of %s!' % (
+            params['ixBug'], ', '.join(found)))
+    return found[0] if found else None
+
+def migrate_shards(queue, destination, get_changes, worker=None):
+    """Migrate the shards in a work queue until there are none left to claim.
+
+    Each change is recorded before it is sent, so if a worker stops while
+    sending a change, the worker resuming the shard first looks for the case
+    it may have created.
+
+    destination -- Sends each (cmd, params, files) change with 'send', to its
+        'dest' connection, using (and adding to) its 'ixBugLookup' of source
+        to destination ixBugs.
+    get_changes -- A function taking the issues of a shard, the number of
+        changes to skip, and a function to call before loading each
+        attachment, and returning the changes to send.
+    worker -- The name of the worker (by default, from worker_name).
+    """
+    worker = worker or worker_name()
+    while 1:
+        shard = queue.claim(worker)
+        if shard is None:
+            break
+        logging.info('%s: migrating shard %i (%i cases, starting at change %i)...',
+                worker, shard.id, len(shard.issues), shard.sent + 1)
+        destination.ixBugLookup = dict(shard.ids)
+        try:
+            # The lease is extended before loading each attachment, as well as
+            # before sending each change.
+            changes = get_changes(shard.issues, shard.sent,
+                    lambda: queue.sending(shard, worker))
+            for i, change in enumerate(changes):
+                index = shard.sent + i
+                cmd, params, files = change
+                created = None
+                if index == shard.sending and cmd == 'new':
+                    created = find_created(destination.dest, params, queue.id_map().values())
+                elif index == shard.sending:
+                    logging.warning('%s: change %i of shard %i may be sent twice.',
+                            worker, index + 1, shard.id)
+                if created is None:
+                    queue.sending(shard, worker, index)
+                    destination.send(change)
+                else:
+                    logging.info('%s: bug %s was already created as %s.', worker,
+                            params['ixBug'], created)
+                    destination.ixBugLookup[params['ixBug']] = created
+                case = None
+                if cmd == 'new':
+                    case = (params['ixBug'], destination.ixBugLookup[params['ixBug']])
+                queue.progress(shard, worker, index + 1, case)
+            queue.finish(shard, worker)
+        except LeaseLost, ex:
+            logging.warning('%s: %s', worker, ex)
+        except (Exception, SystemExit), ex:
+            # The connections exit on errors from the server; that only fails
+            # this shard.
+            logging.exception('%s: failed to migrate shard %i!', worker, shard.id)
+            queue.fail(shard, worker, str(ex))
@@ -18,8 +18,6 @@
 #   License along with this library; if not, see
 #   <http://www.gnu.org/licenses/>.
 
-from collections import namedtuple
-import csv
 import datetime
 import getpass
 import logging
@@ -27,34 +25,32 @@ from optparse import OptionParser
 import os.path
 import random
 import sys
+import threading
+import time
 
+from fogbugz.coalesce import Coalescer
 from fogbugz.connection import Connection, MockConnection
+from fogbugz.fanout import fan_out
+from fogbugz.identity import IdentityCache, server_name
+from fogbugz.placeholders import PlaceholderCloser, missing_ids, verify_placeholders
+from fogbugz.plan import PlanConnection, replay
+from fogbugz.roundup import intern_value, load_class, load_journal, save_snapshots
+from fogbugz.upload import fogbugz_issue_upload, fogbugz_parallel_upload
+from fogbugz.verify import make_digest, verify
 
-doc = '''%s [options] <roundup export directory> [fogbugz server]
-Import a roundup issue archive into a fogbugz database.''' % sys.argv[0]
+doc = '''%s [options] <roundup export directory> [fogbugz server ...]
+Import a roundup issue archive into a fogbugz database.
 
-def load_class(dir, name):
-    """Load the current state of a class from the issues csv.
+If several fogbugz servers are given, the export is only processed once, and
+the issues are uploaded to all of them at once.
 
-    Returns a list of dictionary's, one for each issue. Each dictionary is the
-    (name:value) for each field in the class, and repr."""
-    filename = os.path.join(dir, '%s.csv' % name)
-    contents = csv.reader(open(filename), delimiter=':')
-    Class = namedtuple(name, (h.replace(' ', '_') for h in contents.next()))
-    for row in contents:
-        yield Class(*(eval(c) for c in row))
+With '--compile', the operations are written to a plan file instead of being
+sent (the fogbugz server is optional, and is only used for lookups). With
+'--replay', the only argument is the fogbugz server.
 
-def load_journal(dir, name):
-    '''Load the journal for a given class.
-
-    Returns a dictionary of (id: (timestamp, user, action, contents))'''
-    filename = os.path.join(dir, '%s-journals.csv' % name)
-    Change = namedtuple('Change', ['id', 'timestamp', 'user_id', 'action', 'items'])
-    changes = (Change(*(eval(f) for f in c)) for c in csv.reader(open(filename), delimiter=':'))
-    result = {}
-    for change in changes:
-        result.setdefault(change.id, []).append(change)
-    return result
+With '--verify', the imported issues are compared with the roundup export (using
+the same '--map' and default options as the import), and the differences are
+written to a report.''' % sys.argv[0]
 
 def _reverse_history(item, journal):
     '''Query the history of a given instance.
@@ -80,13 +76,13 @@ def _reverse_history(item, journal):
                 # We are changing a list... add or remove the entires as appropriate.
                 for type, values in mods:
                     if type == '+':
-                        item = item._replace(**{field: [v for v in getattr(item, field) if v not in values]})
+                        item = item._replace(**{field: intern_value([v for v in getattr(item, field) if v not in values], field)})
                     elif type == '-':
-                        item = item._replace(**{field: values + getattr(item, field)})
+                        item = item._replace(**{field: intern_value(values + list(getattr(item, field)), field)})
                     else:
                         raise Exception('Unhandled change %s - %s!' % (type, values))
             else:
-                item = item._replace(**{field:mods})
+                item = item._replace(**{field:intern_value(mods, field)})
         yield item
 
 def mktime(timestamp):
@@ -96,6 +92,9 @@ def mktime(timestamp):
     time_tuple[-2] = int(time_tuple[-2])
     return datetime.datetime(*time_tuple)
 
+def _seconds(params):
+    return time.mktime(params['dt'].timetuple()) + params['dt'].microsecond / 1000000.0
+
 def history(item, journal):
     # Roundup has multiple journal entries for one unique state; if we find two
     # entries very close in time to each other, collapse them.
@@ -127,24 +126,31 @@ class Lookup (dict):
 
 
 def get_tags(keywords, keyword_lookup, project_lookup):
+    """Get the (project keyword, tags) for the keywords of an issue.
+
+    The project keyword is None if there wasn't a keyword that identified a
+    project (ie: the issue goes in the default project)."""
     project = None
     tags = []
     for keyword in keywords:
-        try:
-            project = project_lookup[keyword]
-        except KeyError:
+        if keyword in project_lookup:
+            project = keyword
+        else:
             tags.append(keyword_lookup[keyword].replace(' ', '-'))
-    if project is None:
-        # There wasn't a tag that identified a project, so use the default.
-        project = project_lookup[None]
     return project, tags
 
 class FogbugzUsers:
-    """ A class to create users in the fogbugz database on demand."""
-    def __init__(self, users, defaultUserName, connection):
+    """ A class to create users in the fogbugz database on demand.
+
+    cache -- An IdentityCache of the users created by previous runs.
+    """
+    def __init__(self, users, defaultUserName, connection, cache=None):
         self._connection = connection
         self._users = users
-        self._lookup = {}
+        self._cache = cache
+        self._lookup = cache.get('ixPerson') if cache is not None else {}
+        # The issues may be uploaded from several threads.
+        self._lock = threading.Lock()
 
         self._default_user_id = None
         if defaultUserName:
@@ -156,6 +162,13 @@ class FogbugzUsers:
                 sys.exit("Unable to find user name '%s' to be default user! Users are:\n%s" % (defaultUserName, [u.realname for u in users]))
 
     def get_ixperson(self, roundupId):
+        self._lock.acquire()
+        try:
+            return self._get_ixperson(roundupId)
+        finally:
+            self._lock.release()
+
+    def _get_ixperson(self, roundupId):
         if roundupId is None:
             if self._default_user_id is None:
                 sys.exit('No default user found, but one is required. Use the command line to specify a default.')
@@ -174,14 +187,17 @@ class FogbugzUsers:
                     'sFullname':user.realname,
                     'fActive':(1 if not user.is_retired else 0),
                     }, element='person/ixPerson').text
+                if self._cache is not None:
+                    self._cache.add('ixPerson', user.id, self._lookup[user.id])
                 return self._lookup[user.id]
         sys.exit("Failed to find user with id '%s'." % (roundupId))
 
-def fogbugz_issue_upload(issue_history, users, message_lookup,
-        keyword_lookup, project_lookup, file_lookup, status_lookup,
-        priority_lookup, connection):
-    """Upload issue changes to fogbugz."""
-    roundup_priority = dict((name, id) for (id, name) in priority_lookup.items())
+def fogbugz_issue_commands(issue_history, message_lookup, keyword_lookup,
+        project_lookup, file_lookup, status_lookup, priority_lookup):
+    """Get the (cmd, params, files) changes to upload for an issue.
+
+    The params refer to the roundup users, and the project keyword (see
+    get_tags); fogbugz_issue_upload maps these to the fogbugz ids."""
     fogbugz_priority = {
             'critical' : (1, 'Bug'),
             'urgent' : (2, 'Bug'),
@@ -189,33 +205,31 @@ def fogbugz_issue_upload(issue_history, users, message_lookup,
             'feature' : (4, 'Feature'),
             'wish' : (5, 'Feature'),
             }
-    ixbug = None
+    cmd = None
     existing_messages = []
     existing_files = []
     for issue in issue_history:
         project_id, tags = get_tags(issue.keyword, keyword_lookup, project_lookup)
 
         params = {}
-        if ixbug is None:
+        if cmd is None:
             cmd = 'new'
+        elif issue.status is None or status_lookup[issue.status] == 'resolved':
+            cmd = 'resolve'
+        elif cmd == 'resolve':
+            cmd = 'reactivate'
         else:
-            params['ixBug'] = ixbug
-            if issue.status is None or status_lookup[issue.status] == 'resolved':
-                cmd = 'resolve'
-            elif cmd == 'resolve':
-                cmd = 'reactivate'
-            else:
-                cmd = 'edit'
+            cmd = 'edit'
 
         params['sTags'] = ','.join(tags)
         params['sTitle'] = issue.title
         params['ixProject'] = project_id
         # params['ixCategory'] = 
         if issue.assignedto is None:
-            params['ixPersonAssignedTo'] = users.get_ixperson(issue.creator)
+            params['ixPersonAssignedTo'] = issue.creator
         else:
-            params['ixPersonAssignedTo'] = users.get_ixperson(issue.assignedto)
-        params['ixPersonEditedBy'] = users.get_ixperson(issue.actor)
+            params['ixPersonAssignedTo'] = issue.assignedto
+        params['ixPersonEditedBy'] = issue.actor
         params['dt'] = mktime(issue.activity)
         params['ixPriority'], params['sCategory'] = fogbugz_priority[priority_lookup[issue.priority]]
 
@@ -235,16 +249,55 @@ def fogbugz_issue_upload(issue_history, users, message_lookup,
             logging.info("Note: not removing attachment %s from %s as this isn't " \
                 "supported by the fogbugz api.", removed_attachments, issue)
         existing_files = [id for id in issue.files]
-        response = connection.post(cmd, params, files, 'case')
-        if ixbug is None:
-            ixbug = response.attrib['ixBug']
+        yield cmd, params, files
 
     if cmd == 'resolve':
         # If the final status is resolved, assume it has been fixed
-        connection.post('close', {'ixBug':ixbug})
+        yield 'close', {}, []
+
+def roundup_digest(issue_history, message_lookup, keyword_lookup,
+        project_names, file_lookup, status_lookup, user_names):
+    """Get the verify Digest of an issue, as fogbugz_issue_commands uploads it.
+
+    project_names -- A Lookup of project keywords to project names.
+    user_names -- A Lookup of roundup user ids to their real names.
+    """
+    messages = set()
+    files = set()
+    for issue in issue_history:
+        messages.update(issue.messages)
+        files.update(issue.files)
+    project, tags = get_tags(issue.keyword, keyword_lookup, project_names)
+    if len(issue_history) > 1 and (issue.status is None or
+            status_lookup[issue.status] == 'resolved'):
+        # Resolved issues are closed after the upload.
+        status = 'Closed'
+    else:
+        status = 'Active'
+    return make_digest(issue.title, status, project_names[project], tags,
+            user_names[issue.assignedto if issue.assignedto is not None else issue.creator],
+            [message_lookup[id] for id in messages],
+            [file_lookup[id][0] for id in files])
+
+def _project_names(keywords, mapping, default_project):
+    """Get a Lookup of the project keywords to the project names in '--map'."""
+    result = Lookup('projects')
+    ids = dict((name, id) for id, name in keywords.items())
+    for keyword, project in [m.split(':') for m in mapping or []]:
+        try:
+            result[ids[keyword]] = project
+        except KeyError:
+            sys.exit("Unknown keyword '%s' used for project mapping! Keywords are:\n%s" %
+                    (keyword, ', '.join(keywords.values())))
+    result.default = default_project
+    return result
 
+def fogbugz_create_projects(keywords, mapping, default_project, users,
+        connection, cache=None):
+    """Create the projects in '--map', returning a Lookup of keyword to ixProject.
 
-def fogbugz_create_projects(keywords, mapping, default_project, users, connection):
+    cache -- An IdentityCache of the projects created by previous runs.
+    """
     result = Lookup('projects')
     names = {}
     if mapping:
@@ -255,11 +308,16 @@ def fogbugz_create_projects(keywords, mapping, default_project, users, connectio
             except KeyError:
                 sys.exit("Unknown keyword '%s' used for project mapping! Keywords are:\n%s" %
                         (keyword, ', '.join(keywords.values())))
-            result[id] = connection.post('newProject', {
-                'sProject':project,
-                'ixPersonPrimaryContact':users.get_ixperson(None),
-                },
-                element='project/ixProject').text
+            if cache is not None and cache.lookup('ixProject', project) is not None:
+                result[id] = cache.lookup('ixProject', project)
+            else:
+                result[id] = connection.post('newProject', {
+                    'sProject':project,
+                    'ixPersonPrimaryContact':users.get_ixperson(None),
+                    },
+                    element='project/ixProject').text
+                if cache is not None:
+                    cache.add('ixProject', project, result[id])
             names[project] = result[id]
     if default_project is not None:
         try:
@@ -269,18 +327,76 @@ def fogbugz_create_projects(keywords, mapping, default_project, users, connectio
     return result
 
 def _create_placeholder_bug(project_lookup, users, connection):
-    """Create an closed placeholder bug to remove the missing bug id."""
+    """Create a placeholder bug to take up a missing bug id.
+
+    Returns the ixBug of the new bug; it still needs to be resolved and closed
+    (see PlaceholderCloser)."""
     params = {
             'ixProject': project_lookup[None],
             'ixPersonAssignedTo': users.get_ixperson(None),
             'sTitle': 'Placeholder bug to take into account a missing roundup bug id.',
             }
-    params['ixBug'] = connection.post('new', params, [], 'case').attrib['ixBug']
-    connection.post('resolve', params, [])
-    connection.post('close', params, [])
+    return connection.post('new', params, [], 'case').attrib['ixBug']
+
+class FogbugzDestination:
+    """One of several fogbugz servers the issues are uploaded to at once."""
+    def __init__(self, name, connection, users, project_lookup, closer):
+        self.name = name
+        self.connection = connection
+        self.users = users
+        self.project_lookup = project_lookup
+        self.closer = closer
+
+    def send(self, item):
+        """Upload an item from _upload_items."""
+        id, commands = item
+        if commands is None:
+            logging.info('%s: creating placeholder bug to skip issue %i...', self.name, id)
+            self.closer.add(_create_placeholder_bug(self.project_lookup,
+                self.users, self.connection))
+        else:
+            fogbugz_issue_upload(commands, self.users, self.project_lookup, self.connection)
+
+    def finish(self):
+        verify_placeholders(self.closer.finish(), self.connection)
+        self.connection.log_statistics()
+
+# With '--parallel', the rest of the commands of this many issues are kept
+# after they are created (each holding its reconstructed history); the rest
+# are reconstructed again when they are uploaded.
+_kept_histories = 1000
+
+def _remaining_commands(issue_commands, issue):
+    """Reconstruct the commands of an issue after its 'new' (when uploaded)."""
+    commands = issue_commands(issue)
+    commands.next()
+    for command in commands:
+        yield command
+
+def _upload_items(issues, missing, issue_commands):
+    """Yield the (roundup id, commands) to upload, in id order.
+
+    The commands are None for the placeholder bugs. The commands (and their
+    attachments) are shared between the destinations.
+    """
+    missing = list(reversed(missing))
+    for issue in issues:
+        while missing and missing[-1] < int(issue.id):
+            yield missing.pop(), None
+        logging.info('uploading issue %s of %s...', issue.id, issues[-1].id)
+        yield issue.id, list(issue_commands(issue))
 
 def main():
     parser = OptionParser(usage=doc)
+    parser.add_option('--compile', help="Write the operations to a plan file "
+            "instead of sending them to the fogbugz server.", metavar="PLAN")
+    parser.add_option('--replay', help="Send the operations in a plan file "
+            "(created with '--compile') to the fogbugz server.", metavar="PLAN")
+    parser.add_option('--replay-log', help="Record the replayed operations "
+            "in a file, so a failed replay can be resumed (to the same server).",
+            metavar="FILE")
+    parser.add_option('--compress-requests', help="Gzip large requests to "
+            "the fogbugz server (if it accepts it).", action='store_true')
     parser.add_option('--map' ,help="Map a roundup keyword to a project name. " \
             "If it finds the given tag in an issue, it will remove that keyword, "
             "and assign the issue to the given project.", metavar="KEYWORD:PROJECT",
@@ -293,19 +409,57 @@ def main():
             "create placeholder issues to keep the roundup to fogbugz ids "
             "syncronised. This flag will disable the creation of placeholder issues.",
             action='store_true')
+    parser.add_option('--parallel', help="Create all of the issues in order "
+            "first, then upload the rest of their history concurrently over "
+            "the given number of connections.", metavar="CONNECTIONS", type='int')
+    parser.add_option('--destination-buffer', help="With several fogbugz "
+            "servers, the number of issues a slow server can fall behind the "
+            "others by (default %default).", metavar="COUNT", type='int', default=100)
+    parser.add_option('--coalesce-window', help="Send the changes to an issue "
+            "by the same user within this many seconds as one request (where "
+            "nothing would be lost).", metavar="SECONDS", type='float')
+    parser.add_option('--identity-cache', help="Remember the users and "
+            "projects created in the fogbugz server in a file, so later runs "
+            "reuse them instead of creating them again.", metavar="FILE")
+    parser.add_option('--verify', help="Compare the issues in the fogbugz "
+            "server with the roundup export, writing the differences to a report.",
+            metavar="REPORT")
     parser.add_option('--verbose', help='Verbose logging.', action='store_true')
     options, args = parser.parse_args()
     logging.basicConfig(level=(logging.DEBUG if options.verbose else logging.INFO))
+    if options.parallel and options.compile:
+        sys.exit("'--parallel' can't be used with '--compile'.")
+    if options.verify and (len(args) != 2 or options.compile or options.disable_placeholder_bugs):
+        sys.exit("Verifying needs the fogbugz server, and the fogbugz ids to match "
+                "the roundup ids (ie: without '--disable-placeholder-bugs').")
+    if options.replay:
+        if len(args) != 1:
+            sys.exit("Replaying a plan needs only the fogbugz server. See '%s -h' for more info." % sys.argv[0])
+        connection = Connection(args[0], compress_requests=options.compress_requests)
+        replay(options.replay, connection, options.replay_log)
+        connection.log_statistics()
+        return
+
     if len(args) < 1:
         sys.exit("Missing roundup export directory argument! See '%s -h' for more info." % sys.argv[0])
     elif len(args) == 1:
         # There isn't an explicit fogbugz server
-        connection = MockConnection()
+        if options.compile:
+            connection = PlanConnection(options.compile)
+        else:
+            connection = MockConnection()
     elif len(args) == 2:
-        connection = Connection(args[1])
-    else:
-        sys.exit("Too many arguments! See '%s -h' for more info." % sys.argv[0])
+        connection = Connection(args[1], compress_requests=options.compress_requests)
+        if options.compile:
+            connection = PlanConnection(options.compile, connection)
+    elif options.compile or options.parallel or options.verify or options.identity_cache:
+        sys.exit("'--compile', '--parallel', '--verify' and '--identity-cache' need "
+                "a single fogbugz server. See '%s -h' for more info." % sys.argv[0])
     directory = args[0]
+    servers = args[1:] if len(args) > 2 else []
+    if len(set(server_name(url) for url in servers)) != len(servers):
+        # The servers are reported (and their errors kept) by name.
+        sys.exit("The fogbugz servers must be different. See '%s -h' for more info." % sys.argv[0])
 
     # Load the support classes
     roundupUsers = list(load_class(directory, 'user'))
@@ -314,13 +468,6 @@ def main():
         for message in load_class(directory, 'msg'))
     keyword_lookup = dict((keyword.id, keyword.name) for keyword in load_class(directory, 'keyword'))
 
-    # Upload the projects
-    users = FogbugzUsers(roundupUsers, options.default_user, connection)
-
-    # Check the keyword -> project mapping
-    project_lookup = fogbugz_create_projects(keyword_lookup, options.map,
-            options.default_project, users, connection)
-
     # Load the issues
     issues = list(load_class(directory, 'issue'))
     issues.sort(key=lambda i: int(i.id))
@@ -332,23 +479,147 @@ def main():
     file_lookup = dict((file.id, (file.name,
         os.path.join(directory, 'file-files', '0', 'file%s' % file.id)))
         for file in load_class(directory, 'file'))
+    # Write the classes that were parsed into the snapshot (once).
+    save_snapshots()
+
+    if options.verify:
+        user_names = Lookup('users')
+        user_names.update((user.id, user.realname) for user in roundupUsers)
+        user_names.default = options.default_user
+        project_names = _project_names(keyword_lookup, options.map, options.default_project)
+        def digests():
+            for issue in issues:
+                changes = list(history(issue, journal))
+                changes.reverse()
+                yield issue.id, roundup_digest(changes, message_lookup, keyword_lookup,
+                        project_names, file_lookup, status_lookup, user_names)
+        connections = [connection] + [Connection(args[1], name='verify %i' % (i + 2),
+            compress_requests=options.compress_requests)
+            for i in range((options.parallel or 4) - 1)]
+        # The fogbugz ids match the roundup ids.
+        cases, different = verify(digests(), connections,
+                dict((issue.id, issue.id) for issue in issues), options.verify)
+        if different:
+            sys.exit('%i of %i issues differ; see %s.' % (different, cases, options.verify))
+        return
+
+    cache = None
+    if options.identity_cache:
+        if len(args) != 2:
+            sys.exit("'--identity-cache' needs the fogbugz server. See '%s -h' for more info." % sys.argv[0])
+        # When compiling, the created ids are only references in the plan.
+        cache = IdentityCache(options.identity_cache, os.path.abspath(directory),
+                server_name(args[1]), read_only=bool(options.compile))
+        cache.validate('ixPerson', [ixperson.text for ixperson in connection.post(
+            'listPeople', {'fIncludeDeleted':'1'}).findall('people/person/ixPerson')])
+        cache.validate('ixProject', [ixproject.text for ixproject in connection.post(
+            'listProjects', {'fIncludeDeleted':'1'}).findall('projects/project/ixProject')])
+
+    # Work out the missing ids up front. Only creating the placeholders has to
+    # happen in order; closing them happens in the background (or at the end).
+    missing = [] if options.disable_placeholder_bugs else missing_ids(issues)
+    logging.info('%i placeholder bugs are needed to keep the ids in step.', len(missing))
+
+    destinations = []
+    for url in servers:
+        name = server_name(url)
+        connection = Connection(url, name=name, compress_requests=options.compress_requests)
+        users = FogbugzUsers(roundupUsers, options.default_user, connection)
+        project_lookup = fogbugz_create_projects(keyword_lookup, options.map,
+                options.default_project, users, connection)
+        closer = PlaceholderCloser(Connection(url, name='%s placeholders' % name,
+            compress_requests=options.compress_requests), threaded=True)
+        destinations.append(FogbugzDestination(name, connection, users,
+            project_lookup, closer))
+
+    if not servers:
+        # Upload the projects
+        users = FogbugzUsers(roundupUsers, options.default_user, connection, cache)
+
+        # Check the keyword -> project mapping
+        project_lookup = fogbugz_create_projects(keyword_lookup, options.map,
+                options.default_project, users, connection, cache)
+
+        if len(args) == 2 and not options.compile:
+            closer = PlaceholderCloser(Connection(args[1], name='placeholders',
+                compress_requests=options.compress_requests), threaded=True)
+        else:
+            closer = PlaceholderCloser(connection)
 
-    i = 1
-    for issue in issues:
-        if not options.disable_placeholder_bugs:
-            while int(issue.id) > i:
-                logging.info('Creating placeholder bug to skip issue %i...', i)
-                _create_placeholder_bug(project_lookup, users, connection)
-                i += 1
-            assert int(issue.id) == i, 'Expected issue with id %i, got %s' % (i, issue.id)
-            i = int(issue.id) + 1
+    coalescer = None
+    if options.coalesce_window is not None:
+        coalescer = Coalescer(options.coalesce_window, 'ixPersonEditedBy', _seconds)
 
-        logging.info('uploading issue %s of %s...', issue.id, issues[-1].id)
+    def issue_commands(issue):
         changes = list(history(issue, journal))
         changes.reverse()
-        fogbugz_issue_upload(changes, users, message_lookup,
-                keyword_lookup, project_lookup, file_lookup, status_lookup,
-                priority_lookup, connection)
+        commands = fogbugz_issue_commands(changes, message_lookup, keyword_lookup,
+                project_lookup, file_lookup, status_lookup, priority_lookup)
+        if coalescer is not None:
+            commands = coalescer.coalesce(commands)
+        return commands
+
+    if servers:
+        # The commands only refer to the project keywords, so they are the
+        # same for every server.
+        errors = fan_out(_upload_items(issues, missing, issue_commands),
+                [(d.name, d.send) for d in destinations], options.destination_buffer)
+        for destination in destinations:
+            if destination.name not in errors:
+                destination.finish()
+        if coalescer is not None:
+            coalescer.log_statistics()
+        if errors:
+            sys.exit('Failed to upload to %s!' % ', '.join(sorted(errors)))
+        return
+
+    missing.reverse()
+    ixbugs = {}
+    histories = []
+    for issue in issues:
+        while missing and missing[-1] < int(issue.id):
+            logging.info('Creating placeholder bug to skip issue %i...', missing.pop())
+            closer.add(_create_placeholder_bug(project_lookup, users, connection))
+
+        if options.parallel:
+            # Only create the issue for now; the rest of the history is
+            # uploaded once all the ids have been allocated. The rest of the
+            # commands of the first issues are kept, so their histories are
+            # only reconstructed once.
+            logging.info('creating issue %s of %s...', issue.id, issues[-1].id)
+            commands = issue_commands(issue)
+            if len(histories) < _kept_histories:
+                histories.append((issue.id, commands))
+            else:
+                histories.append((issue.id, _remaining_commands(issue_commands, issue)))
+            commands = [commands.next()]
+        else:
+            logging.info('uploading issue %s of %s...', issue.id, issues[-1].id)
+            commands = issue_commands(issue)
+        ixbugs[issue.id] = fogbugz_issue_upload(commands, users, project_lookup, connection)
+
+    if options.parallel:
+        if len(args) == 2:
+            connections = [Connection(args[1], name='upload %i' % (i + 1),
+                compress_requests=options.compress_requests)
+                for i in range(options.parallel)]
+        else:
+            connections = [MockConnection('upload %i' % (i + 1))
+                for i in range(options.parallel)]
+        fogbugz_parallel_upload(histories, ixbugs, users, project_lookup, connections)
+        for upload in connections:
+            upload.log_statistics()
+
+    placeholders = closer.finish()
+    if len(args) == 2 and not options.compile:
+        verify_placeholders(placeholders, connection)
+    if coalescer is not None:
+        coalescer.log_statistics()
+    if options.compile:
+        connection.close()
+    if cache is not None:
+        cache.close()
+    connection.log_statistics()
 
 if __name__ == '__main__':
     main()